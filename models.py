@@ -1,6 +1,17 @@
 import random
 import copy
+import hashlib
 from collections import deque
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:  # labelling falls back to a union-find
+    ndimage = None
+
+# Occupancy grid codes, entity cells hold the entity id (>= 0)
+WALL = -2
+FREE = -1
 
 class Layout:
     def __init__(self, width, length) -> None:
@@ -9,6 +20,15 @@ class Layout:
         self.aisle_width = 1  # Default aisle width
         self.builder = Builder(self)
         self.fitness = 0
+        self._shared = set()  # Attributes borrowed from the layout this was cloned from
+        self.context = None  # StaticContext shared by every layout of an optimisation run
+        self.track_routes = False  # Keep incremental route state when evaluated
+        self.pathfinding = None  # operation_routes backend; None uses the pure-Python distance fields
+        self.route_state = None
+        self.parent_route_state = None
+        self.track_fitness = False  # Keep per-operation routes and per-entity scores when evaluated
+        self.fitness_state = None
+        self.parent_fitness_state = None
         self.entities = []
         self.operations = []
         self.structure = {
@@ -40,17 +60,190 @@ class Layout:
             self.structure['wall'].append(pos1)
             self.structure['wall'].append(pos2)
 
-        for y in range(0, length + 1):
+        for y in range(1, length + 1):
             pos1 = (0, y)
             pos2 = (width + 1, y)
             self.structure['wall'].append(pos1)
             self.structure['wall'].append(pos2)
 
+        # Array view of the floor indexed [x, y], kept in sync with the dicts above
+        self.grid = np.full((width + 2, length + 2), FREE, dtype=np.int32)
+        self._grid_rows = None
+        self._grid_key = None
+        self._wide_masks = {}
+        self._components = None
+        self._bitboard = None
+        self._wide_rows = {}
+        self.zone_masks = {zone: np.zeros(self.grid.shape, dtype=bool) for zone in self.zones}
+        self._mark(self.structure['wall'], WALL)
+
+    def _mark(self, cells, value):
+        """Write value into the occupancy grid for every in-bounds cell."""
+        for cell in cells:
+            x, y = int(cell[0]), int(cell[1])
+            if 0 <= x < self.grid.shape[0] and 0 <= y < self.grid.shape[1]:
+                self.grid[x, y] = value
+                if self._grid_rows is not None:
+                    self._grid_rows[x][y] = value
+        self._grid_key = None
+        self._wide_masks = {}
+        self._components = None
+        self._bitboard = None
+        self._wide_rows = {}
+        self.builder.update_free_cells(cells, value == FREE)
+
+    @property
+    def grid_key(self):
+        """Digest of the occupancy grid, used to key cached search results."""
+        if self._grid_key is None:
+            self._grid_key = (self.grid.shape, hashlib.blake2b(self.grid.tobytes(), digest_size=16).digest())
+        return self._grid_key
+
+    def wide_mask(self, aisle_width):
+        """Boolean grid, True on the free cells a vehicle of aisle_width fits on (see vehicle_cells)."""
+        mask = self._wide_masks.get(aisle_width)
+        if mask is None:
+            mask = _read_only(vehicle_cells(self.grid == FREE, aisle_width))
+            self._wide_masks[aisle_width] = mask
+        return mask
+
+    def free_components(self):
+        """Labels of the 4-connected components of free cells, 0 on walls and entities."""
+        if self._components is None:
+            self._components = label_components(self.grid == FREE)
+        return self._components
+
+    @property
+    def bitboard(self):
+        """Bitboard of the current grid, for whole-frontier route lengths."""
+        if self._bitboard is None:
+            self._bitboard = Bitboard(self)
+        return self._bitboard
+
+    def footprints_connected(self, cells_a, cells_b):
+        """Whether a route of free cells can join two footprints.
+
+        Exact for 1-wide aisles and a necessary condition for wider ones, so a
+        False answer rules out any path search between the two.
+        """
+        if not cells_a or not cells_b:
+            return False
+        labels = self.free_components()
+        cells_b = {(c[0], c[1]) for c in cells_b}
+        reached = set()
+        for x, y in cells_a:
+            for dx, dy in ((0, 1), (0, -1), (1, 0), (-1, 0)):
+                if (x + dx, y + dy) in cells_b:
+                    return True
+                reached.add(int(labels[x + dx, y + dy]))
+        for x, y in cells_b:
+            for dx, dy in ((0, 1), (0, -1), (1, 0), (-1, 0)):
+                label = int(labels[x + dx, y + dy])
+                if label and label in reached:
+                    return True
+        return False
+
+    def wide_rows(self, aisle_width):
+        """Nested lists, True where a vehicle of aisle_width fits on the cell."""
+        rows = self._wide_rows.get(aisle_width)
+        if rows is None:
+            rows = self.wide_mask(aisle_width).tolist()
+            self._wide_rows[aisle_width] = rows
+        return rows
+
+    @property
+    def grid_rows(self):
+        """The occupancy grid as nested lists, for fast per-cell reads in Python loops."""
+        if self._grid_rows is None:
+            self._grid_rows = self.grid.tolist()
+        return self._grid_rows
+
+    def rebuild_grid(self):
+        """Recompute the occupancy grid and zone masks from the dict state."""
+        self.grid = np.full((self.width + 2, self.length + 2), FREE, dtype=np.int32)
+        self._grid_rows = None
+        self._grid_key = None
+        self._wide_masks = {}
+        self._components = None
+        self._bitboard = None
+        self._wide_rows = {}
+        self._mark(self.structure.get('wall', []), WALL)
+        for entity in self.entities:
+            self._mark(entity.get('positions', []), entity['id'])
+
+        self.zone_masks = {}
+        for zone, coords in self.zones.items():
+            mask = np.zeros(self.grid.shape, dtype=bool)
+            for x, y in coords:
+                if 0 <= x < mask.shape[0] and 0 <= y < mask.shape[1]:
+                    mask[x, y] = True
+            self.zone_masks[zone] = mask
+        self._shared.discard('zone_masks')
+        self.builder.reset_free_cells()
+
+    def in_bounds(self, pos):
+        return 1 <= pos[0] <= self.width and 1 <= pos[1] <= self.length
+
+    def in_zone(self, pos, zone):
+        mask = self.zone_masks.get(zone)
+        return mask is not None and bool(mask[pos[0], pos[1]])
+
+    def clone(self):
+        """Cheap copy for the optimiser.
+
+        Walls, zones, utilities and manually placed entities are shared with
+        self by reference and only copied when one of the add_* methods writes
+        to them, on either layout. Auto-placed entities, operations and the
+        occupancy grid are copied so the clone can be re-placed independently.
+        """
+        layout = Layout.__new__(Layout)
+        layout.__dict__.update(self.__dict__)
+        layout.grid = self.grid.copy()
+        layout._grid_rows = None
+        layout._wide_rows = dict(self._wide_rows)
+        layout._wide_masks = dict(self._wide_masks)
+        layout._bitboard = None
+        layout.entities = [
+            dict(entity, positions=list(entity['positions'])) if entity['placement'] == 'auto' else entity
+            for entity in self.entities
+        ]
+        layout.refresh_operations()
+        layout.route_state = None
+        layout.parent_route_state = self.route_state
+        layout.fitness_state = None
+        layout.parent_fitness_state = self.fitness_state
+        layout._shared = {'structure', 'zones', 'zone_masks', 'utilities', 'manual_entities'}
+        self._shared |= layout._shared
+
+        layout.builder = Builder(layout)
+        layout.builder.astar = self.builder.astar
+        if self.builder._free is not None:
+            layout.builder._free = set(self.builder._free)
+        return layout
+
+    def _own(self, *names):
+        """Copy shared attributes before this layout writes to them."""
+        for name in names:
+            if name not in self._shared:
+                continue
+            self._shared.discard(name)
+            if name == 'manual_entities':
+                self.entities = [
+                    copy.deepcopy(entity) if entity['placement'] == 'manual' else entity
+                    for entity in self.entities
+                ]
+                self.refresh_operations()
+            else:
+                setattr(self, name, copy.deepcopy(getattr(self, name)))
+
     def add_structure(self, layout):
+        self._own('structure')
         for coord in layout.keys():
             pos = tuple([int(n) for n in coord.split(',')])
             entity_type = layout[coord]
             self.structure[entity_type].append(pos)
+            if entity_type == 'wall':
+                self._mark([pos], WALL)
         
         for key in self.structure.keys():
             if key != 'wall':
@@ -70,13 +263,18 @@ class Layout:
                         'within_zone':'none',
                         'positions':group
                         })
+                    self._mark(group, id)
                     id+=1
 
     def add_zones(self, layout):
+        self._own('zones', 'zone_masks')
         for coord in layout.keys():
-            self.zones[layout[coord]].append([int(n) for n in coord.split(',')])
+            pos = [int(n) for n in coord.split(',')]
+            self.zones[layout[coord]].append(pos)
+            self.zone_masks[layout[coord]][pos[0], pos[1]] = True
 
     def add_utilities(self, layout):
+        self._own('utilities')
         for coord in layout.keys():
             self.utilities[layout[coord]].append([int(n) for n in coord.split(',')])
 
@@ -102,11 +300,17 @@ class Layout:
 
     def add_positions(self, layout):
         for coord in layout.keys():
-            self.entities[int(layout[coord])]['positions'].append([int(n) for n in coord.split(',')])
+            pos = [int(n) for n in coord.split(',')]
+            entity_id = int(layout[coord])
+            if self.entities[entity_id]['placement'] != 'auto':
+                self._own('manual_entities')
+            self.entities[entity_id]['positions'].append(pos)
+            self._mark([pos], entity_id)
     
     def delete_positions(self):
         for entity in self.entities:
             if entity['placement'] == 'auto':
+                self._mark(entity['positions'], FREE)
                 entity['positions'] = []
 
     def refresh_operations(self):
@@ -170,9 +374,48 @@ class Layout:
         layout.zones = data['zones']
         layout.utilities = data['utilities']
         layout.operations = data['operations']
+        layout.rebuild_grid()
 
         return layout
     
+class StaticContext:
+    """Read-only data that stays the same for every individual of a run.
+
+    Built once from the base layout by the optimiser and shared by the GA,
+    every Builder and the fitness functions, so per-individual work only
+    touches auto-placed entities.
+    """
+    def __init__(self, layout):
+        self.shape = layout.grid.shape
+        self.zone_masks = {zone: _read_only(mask.copy()) for zone, mask in layout.zone_masks.items()}
+
+        # Manual entities never move, so neither do their centroids
+        self.manual_centroids = {}
+        for entity in layout.manual_placed_entities:
+            cells = entity['positions']
+            if cells:
+                self.manual_centroids[entity['id']] = (sum(p[0] for p in cells) / len(cells),
+                                                       sum(p[1] for p in cells) / len(cells))
+
+        # Manhattan distance from every cell to the nearest utility point of each type
+        xs, ys = np.indices(self.shape)
+        self.utility_points = {}
+        self.utility_distance = {}
+        for utility_type, points in layout.utilities.items():
+            points = np.array([(p[0], p[1]) for p in points], dtype=np.int64).reshape(-1, 2)
+            self.utility_points[utility_type] = _read_only(points)
+            field = np.full(self.shape, np.inf)
+            for px, py in points:
+                np.minimum(field, np.abs(xs - px) + np.abs(ys - py), out=field)
+            self.utility_distance[utility_type] = _read_only(field)
+
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('StaticContext is read-only')
+        super().__setattr__(name, value)
+
 class Operation:
     def __init__(self, from_entity, to_entity, frequency=1, id=None):
         self.id = id
@@ -197,78 +440,149 @@ class Builder:
     def __init__(self, layout) -> None:
         self.layout = layout
         self.astar = None  # Will be set by the caller
+        self._free = None  # Set of free interior cells, built lazily from layout.grid
 
     def set_astar(self, astar_func):
         """Set the A* pathfinding function."""
         self.astar = astar_func
 
+    @property
+    def free_cells(self):
+        """Set of interior cells that are neither walls nor occupied."""
+        if self._free is None:
+            xs, ys = np.nonzero(self.layout.grid == FREE)
+            self._free = set(zip(xs.tolist(), ys.tolist()))
+        return self._free
+
+    def update_free_cells(self, cells, free):
+        """Keep the free-cell index in step with a grid write (O(len(cells)))."""
+        if self._free is None:
+            return
+        for cell in cells:
+            pos = (int(cell[0]), int(cell[1]))
+            if not self.layout.in_bounds(pos):
+                continue
+            if free:
+                self._free.add(pos)
+            else:
+                self._free.discard(pos)
+
+    def reset_free_cells(self):
+        self._free = None
+
     def get_available_positions(self):
         """Get all available positions that are not walls or occupied."""
-        available = []
-        for x in range(1, self.layout.width + 1):
-            for y in range(1, self.layout.length + 1):
-                pos = (x, y)
-                if (pos not in self.layout.structure.get('wall', []) and 
-                    not any(p == pos for e in self.layout.entities for p in e.get('positions'))):
-                    available.append(pos)
-        return available
+        return sorted(self.free_cells)
+
+    def footprint(self, pos, entity):
+        """Cells covered by entity when anchored at pos."""
+        return [(x, y)
+                for x in range(pos[0], pos[0] + entity.get('width', 1))
+                for y in range(pos[1], pos[1] + entity.get('length', 1))]
+
+    def candidate_mask(self, entity):
+        """Boolean mask over layout.grid of every valid anchor for entity.
+
+        Equivalent to calling is_position_valid on every cell, computed in one
+        pass with summed-area tables over the free and zone masks.
+        """
+        width = entity.get('width', 1)
+        length = entity.get('length', 1)
+        free = self.layout.grid == FREE
+        A, B = free.shape
+        mask = np.zeros(free.shape, dtype=bool)
+        if width + 2 > A or length + 2 > B:
+            return mask
+
+        # Anchors run over x0 in [1, A - width - 1], y0 in [1, B - length - 1]
+        inner = _box_sums(free, width, length)[1:A - width, 1:B - length]
+        outer = _box_sums(free, width + 2, length + 2)
+        corners = (free[:A - width - 1, :B - length - 1].astype(np.int32)
+                   + free[width + 1:, :B - length - 1]
+                   + free[:A - width - 1, length + 1:]
+                   + free[width + 1:, length + 1:])
+        # Free cells edge-adjacent to the footprint
+        ring = outer - inner - corners
+
+        valid = (inner == width * length) & (ring > 0)
+        if entity.get('within_zone', 'none') != 'none':
+            zone_masks = self.layout.context.zone_masks if self.layout.context else self.layout.zone_masks
+            zone = zone_masks.get(entity['within_zone'])
+            if zone is None:
+                return mask
+            valid &= _box_sums(zone, width, length)[1:A - width, 1:B - length] == width * length
+
+        mask[1:A - width, 1:B - length] = valid
+        return mask
+
+    def candidate_positions(self, entity):
+        """All valid anchors for entity, in the same order as get_available_positions."""
+        xs, ys = np.nonzero(self.candidate_mask(entity))
+        return list(zip(xs.tolist(), ys.tolist()))
 
     def is_position_valid(self, pos, entity):
         """Check if a position is valid for an entity."""
         # Check if position is within bounds
-        if not (1 <= pos[0] <= self.layout.width and 1 <= pos[1] <= self.layout.length):
+        if not self.layout.in_bounds(pos):
+            return False
+
+        # Every cell the entity would occupy must be free
+        free = self.free_cells
+        entity_cells = self.footprint(pos, entity)
+        if any(cell not in free for cell in entity_cells):
             return False
-            
+
         # Check zone constraints if specified
-        if entity.get('within_zone') != 'none':
+        if entity.get('within_zone', 'none') != 'none':
             zone_type = entity['within_zone']
-            if pos not in self.layout.zones.get(zone_type, []):
+            if not all(self.layout.in_zone(cell, zone_type) for cell in entity_cells):
                 return False
 
-        width = entity.get('width', 1)
-        length = entity.get('length', 1)
-        
-        # Get all cells that would be occupied by this entity
-        entity_cells = []
-        for x in range(pos[0], pos[0] + width):
-            for y in range(pos[1], pos[1] + length):
-                entity_cells.append((x, y))
-
-        new_entity = copy.deepcopy(entity)
-        new_entity['positions'] =  entity_cells
         # Check if any cell has access to an aisle
-        if not self.has_access_point(new_entity):
-            return False
-
-        return True
+        return self._has_access(entity_cells)
 
     def has_valid_paths(self):
         """Check if all operations have valid paths."""
-        if not self.astar:
-            raise ValueError("A* function not set")
-            
+        aisle_width = self.layout.aisle_width
         for operation in self.layout.operations:
-            temp_paths = []
             from_coords = operation['from_entity']['positions']
             to_coords = operation['to_entity']['positions']
-            for to_coord in to_coords:
-                for from_coord in from_coords:
-                    path = self.astar(from_coord, to_coord, self.layout, self.layout.aisle_width)
-                    if path:
-                        temp_paths.append(path)
-            if temp_paths == []:
+            # Footprints in different components of the aisles have no path at all;
+            # on 1-wide aisles sharing a component is enough for one to exist
+            if not self.layout.footprints_connected(from_coords, to_coords):
+                return False
+            if aisle_width > 1 and self.layout.bitboard.route_length(from_coords, to_coords, aisle_width) is None:
                 return False
 
         return True
 
+    def place_entity(self, entity, pos):
+        """Occupy the footprint of entity anchored at pos."""
+        positions = {}
+        for cell in self.footprint(pos, entity):
+            positions[str(cell)[1:-1]] = entity['id']
+        self.layout.add_positions(positions)
+
     def randomise_layout(self):
         """Randomise the layout while respecting constraints."""
-        if not self.astar:
-            raise ValueError("A* function not set")
-            
         # Get all auto-placed entities
         auto_entities = self.layout.auto_placed_entities
 
+        # Entities each one shares an operation with
+        partners = {}
+        for operation in self.layout.operations:
+            from_id = int(operation['from_entity']['id'])
+            to_id = int(operation['to_entity']['id'])
+            partners.setdefault(from_id, set()).add(to_id)
+            partners.setdefault(to_id, set()).add(from_id)
+
+        # Placing entities only ever removes free cells, so an operation that is
+        # disconnected once both its endpoints are down stays disconnected
+        self.layout.delete_positions()
+        for entity in self.layout.entities:
+            if entity['positions'] and not self._connected_to(entity, partners.get(entity['id'], ())):
+                return False
+
         # Try to find a valid layout
         max_attempts = 100
         for attempt in range(max_attempts):
@@ -279,27 +593,17 @@ class Builder:
             random.shuffle(auto_entities)
             for entity in auto_entities:
                 # Get available positions that respect zone constraints
-                available = []
-                for pos in self.get_available_positions():
-                    if self.is_position_valid(pos, entity):
-                        available.append(pos)
+                available = self.candidate_positions(entity)
                 
                 if not available:
                     success = False
                     break
                     
                 # Randomly choose a position
-                pos = random.choice(available)
-                entity_cells = []
-                for x in range(pos[0], pos[0] + entity['width']):
-                    for y in range(pos[1], pos[1] + entity['length']):
-                        entity_cells.append((x, y))
-                
-                positions = {}
-                for e in entity_cells:
-                    positions[str(e)[1:-1]] = entity['id']
-                
-                self.layout.add_positions(positions)
+                self.place_entity(entity, random.choice(available))
+                if not self._connected_to(entity, partners.get(entity['id'], ())):
+                    success = False
+                    break
             self.layout.refresh_operations()
 
             # If all entities placed, check if paths are valid
@@ -309,9 +613,22 @@ class Builder:
         # If we couldn't find a valid layout after max attempts
         return False
 
+    def _connected_to(self, entity, partner_ids):
+        """Whether entity can reach every placed entity in partner_ids through free cells."""
+        for partner_id in partner_ids:
+            positions = self.layout.entities[partner_id]['positions']
+            if positions and not self.layout.footprints_connected(entity['positions'], positions):
+                return False
+        return True
+
     def has_access_point(self, entity):
         # Check each cell for access to an aisle
-        for cell in entity.get('positions'):
+        return self._has_access(entity.get('positions'))
+
+    def _has_access(self, cells):
+        free = self.free_cells
+        own = {(c[0], c[1]) for c in cells}
+        for cell in own:
             # Check adjacent cells (up, down, left, right)
             adjacent_cells = [
                 (cell[0], cell[1] - 1),  # up
@@ -319,16 +636,149 @@ class Builder:
                 (cell[0] - 1, cell[1]),  # left
                 (cell[0] + 1, cell[1])   # right
             ]
-            
-            all_empty_cells = self.get_available_positions()
+
             for adj_cell in adjacent_cells:
-                # Check if adjacent cell is within bounds
-                if adj_cell in all_empty_cells:
+                if adj_cell in free and adj_cell not in own:
                     return True
-                
+
         return False
     
+class Bitboard:
+    """Cells of a layout's grid as the bits of Python integers.
+
+    Bit x * stride + y stands for cell (x, y) of layout.grid, so moving a
+    whole set of cells one step is a shift by 1 or by stride. The wall ring
+    around the grid keeps shifted interior cells from wrapping into the next
+    row. A breadth-first layer is then four shifts, an OR and a mask,
+    however many cells are on the frontier.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.stride = layout.grid.shape[1]
+        self.free = self.from_mask(layout.grid == FREE)
+        self._open = {}
+
+    def from_mask(self, mask):
+        """Integer with the bits of the True cells of a grid-shaped mask."""
+        return int.from_bytes(np.packbits(mask.ravel(), bitorder='little').tobytes(), 'little')
+
+    def from_cells(self, cells):
+        bits = 0
+        for cell in cells:
+            bits |= 1 << (cell[0] * self.stride + cell[1])
+        return bits
+
+    def step(self, bits):
+        """Cells one 4-connected step from any cell in bits."""
+        return (bits << 1) | (bits >> 1) | (bits << self.stride) | (bits >> self.stride)
+
+    def open_cells(self, aisle_width=1):
+        """Free cells a vehicle of aisle_width fits on."""
+        if aisle_width <= 1:
+            return self.free
+        if aisle_width not in self._open:
+            self._open[aisle_width] = self.from_mask(self.layout.wide_mask(aisle_width))
+        return self._open[aisle_width]
+
+    def layers(self, sources, goals=0, aisle_width=1):
+        """Breadth-first layers out of the footprint sources.
+
+        Yields (d, layer), the cells first reached after d steps. Routes
+        follow get_neighbors: free cells the vehicle fits on, a narrow cell
+        only as the first step or just before a cell of goals, which
+        (like every entity cell) ends the route there.
+        """
+        free = self.free
+        open_ = self.open_cells(aisle_width)
+        docks = self.step(goals) & free & ~open_
+        seen = sources
+        frontier = sources
+        layer = self.step(sources) & ~seen & (free | goals)
+        d = 1
+        while layer:
+            yield d, layer
+            seen |= layer
+            # Only open cells (and, on the first layer, every free cell) lead on
+            frontier = layer & (free if d == 1 else open_)
+            ahead = self.step(frontier) & ~seen
+            ends = self.step(layer & docks & ~frontier) & goals & ~seen
+            layer = (ahead & (open_ | docks | goals)) | ends
+            d += 1
+
+    def route_length(self, sources, goals, aisle_width=1):
+        """Cells on the shortest route between two footprints, or None if there is none."""
+        source_bits = self.from_cells(sources)
+        goal_bits = self.from_cells(goals)
+        if not source_bits or not goal_bits:
+            return None
+        for d, layer in self.layers(source_bits, goal_bits, aisle_width):
+            if layer & goal_bits:
+                return d + 1
+        return None
+
 # more helpers
+
+def vehicle_cells(free, aisle_width):
+    """Cells of a free-cell mask that a vehicle of aisle_width fits on.
+
+    The vehicle covers an aisle_width x aisle_width square reaching
+    (aisle_width - 1) // 2 cells before the cell and aisle_width // 2 after
+    it along each axis: centred for odd widths, one cell further on for even
+    ones, so a 2-wide corridor takes a 2-wide vehicle. Every cell of the
+    square must be free and inside the mask.
+    """
+    if aisle_width <= 1:
+        return free.copy()
+    before = (aisle_width - 1) // 2
+    fits = np.zeros(free.shape, dtype=bool)
+    if aisle_width > min(free.shape):
+        return fits
+    windows = _box_sums(free, aisle_width, aisle_width) == aisle_width * aisle_width
+    fits[before:before + windows.shape[0], before:before + windows.shape[1]] = windows
+    return fits
+
+def label_components(free):
+    """4-connected component labels (1, 2, ...) of a boolean mask, 0 where it is False."""
+    if ndimage is not None:
+        labels, _ = ndimage.label(free)
+        return labels.astype(np.int32)
+
+    length = free.shape[1]
+    cells = free.ravel().tolist()
+    parent = list(range(len(cells)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, open_ in enumerate(cells):
+        if not open_:
+            continue
+        for j in (i - 1 if i % length else -1, i - length):
+            if j >= 0 and cells[j]:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[root_i] = root_j
+
+    labels = np.zeros(len(cells), dtype=np.int32)
+    roots = {}
+    for i, open_ in enumerate(cells):
+        if open_:
+            labels[i] = roots.setdefault(find(i), len(roots) + 1)
+    return labels.reshape(free.shape)
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+def _box_sums(mask, width, length):
+    """Sum of mask over every width x length window, indexed by window origin."""
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int32)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+    return (table[width:, length:] - table[:-width, length:]
+            - table[width:, :-length] + table[:-width, :-length])
     
 def group_touching_clusters(coords):
     coords_set = set(coords)  # For O(1) lookups
@@ -1,25 +1,45 @@
-from .algorithm import ga
+from .algorithm import GA as ga
+from .algorithm import csgraph_routes
+from .algorithm.__helpers import operation_routes
+from models import StaticContext
 from .function import standard_layout_fitness, two_step_fitness
 from .simulation import mesa_warehouse_sim, mapf
 
 get_func = {
     "ga": ga.GA,
     "standard_layout_fitness": standard_layout_fitness.get_fitness,
-    "two_step_fitness": two_step_fitness,
+    "two_step_fitness": two_step_fitness.get_fitness,
     "mesa_warehouse_sim": mesa_warehouse_sim.WarehouseModel,
     "mapf_sim": mapf
 }
 
+# Population-wide versions of the fitness functions, used by the algorithm when available
+get_batch_func = {
+    "standard_layout_fitness": standard_layout_fitness.get_population_fitness,
+    "two_step_fitness": two_step_fitness.get_population_fitness,
+}
+
+# Backends computing every operation's route for the fitness function
+get_pathfinding = {
+    "astar": operation_routes,
+    "csgraph": csgraph_routes.operation_routes,
+}
+
 
 class Optimiser:
-    def __init__(self, layout, algorithm, function, simulation, hyperparameters=None) -> None:
+    def __init__(self, layout, algorithm, function, simulation, hyperparameters=None, pathfinding="astar") -> None:
         self.layout=layout
         self.algorithm=get_func[algorithm]
         self.function=get_func[function]
         self.simulation=get_func[simulation]
+        self.pathfinding=get_pathfinding[pathfinding]
+        self.batch_function=get_batch_func.get(function)
         
     def run_optimisation(self):
-        a = self.algorithm(self.layout, self.function)
+        # Walls, zones, utilities and manual entities are shared by every individual
+        self.context = StaticContext(self.layout)
+        a = self.algorithm(self.layout, self.function, context=self.context, pathfinding=self.pathfinding,
+                           batch_function=self.batch_function)
         a.run()
 
         self.layout1=a.layout1
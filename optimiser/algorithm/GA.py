@@ -1,18 +1,121 @@
+import inspect
 import random
-import copy
 import math
+from functools import partial
+import numpy as np
 from .__helpers import astar
+from .fitness_memo import FitnessMemo
+from .path_cache import MISSING
+from .surrogate import Surrogate, entity_boxes, genome_boxes, layout_features
 from ..function.standard_layout_fitness import get_fitness
 
+class Genome:
+    """Compact GA individual: one anchor cell and orientation per auto-placed entity.
+
+    anchors are flat indices into base.grid and orientation 1 swaps the
+    entity's width and length. The genome is decoded against the shared base
+    layout only when a Layout is actually needed.
+    """
+    def __init__(self, base, anchors, orientation=None):
+        self.base = base
+        self.anchors = np.asarray(anchors, dtype=np.int32)
+        if orientation is None:
+            orientation = np.zeros(len(self.anchors), dtype=np.int8)
+        self.orientation = np.asarray(orientation, dtype=np.int8)
+        self.fitness = 0
+        self.valid = True
+        self.route_state = None
+        self.parent_route_state = None
+        self.fitness_state = None
+        self.parent_fitness_state = None
+        self._layout = None
+
+    @classmethod
+    def from_layout(cls, base, layout):
+        """Encode the auto-placed entities of layout (a clone of base)."""
+        stride = base.grid.shape[1]
+        anchors = []
+        orientation = []
+        for entity, base_entity in zip(layout.auto_placed_entities, base.auto_placed_entities):
+            x, y = min((p[0], p[1]) for p in entity['positions']) if entity['positions'] else (0, 0)
+            anchors.append(x * stride + y)
+            orientation.append(int(entity['width'] != base_entity['width']))
+        genome = cls(base, anchors, orientation)
+        genome._layout = layout
+        return genome
+
+    def copy(self):
+        genome = Genome(self.base, self.anchors.copy(), self.orientation.copy())
+        # A copy of a genome not scored yet repairs from the state its own parent left it
+        genome.parent_route_state = self.route_state if self.route_state is not None else self.parent_route_state
+        genome.parent_fitness_state = (self.fitness_state if self.fitness_state is not None
+                                       else self.parent_fitness_state)
+        return genome
+
+    def decode(self):
+        """Layout for this genome, repairing genes that no longer fit."""
+        if self._layout is not None:
+            return self._layout
+
+        layout = self.base.clone()
+        layout.delete_positions()
+        builder = layout.builder
+        stride = layout.grid.shape[1]
+        for i, entity in enumerate(layout.auto_placed_entities):
+            if self.orientation[i]:
+                entity['width'], entity['length'] = entity['length'], entity['width']
+            pos = divmod(int(self.anchors[i]), stride)
+            if not builder.is_position_valid(pos, entity):
+                available = builder.candidate_positions(entity)
+                if not available:
+                    self.valid = False
+                    break
+                pos = random.choice(available)
+                self.anchors[i] = pos[0] * stride + pos[1]
+            builder.place_entity(entity, pos)
+        layout.refresh_operations()
+        layout.parent_route_state = self.parent_route_state
+        layout.parent_fitness_state = self.parent_fitness_state
+
+        self._layout = layout
+        return layout
+
+    def release(self):
+        """Drop the decoded layout, keeping only the genes."""
+        self._layout = None
+
+    def to_dict(self):
+        return self.decode().to_dict()
+
 class GA:
-    def __init__(self, layout, function, population_size=20, mutation_rate=0.1, crossover_rate=0.8, simulation_threshold=0.7, elite_size=3):
+    def __init__(self, layout, function, population_size=20, mutation_rate=0.1, crossover_rate=0.8, simulation_threshold=0.7, elite_size=3, encoding='layout', context=None, incremental=False, delta=False, pathfinding=None, batch_function=None, memo_size=4096, surrogate=False, surrogate_pool=3):
         self.base_layout = layout
+        # Keep the distance fields behind the routes so children repair them rather than search again
+        layout.track_routes = incremental
+        # Keep per-operation routes and per-entity scores so children rescore only what moved
+        layout.track_fitness = delta
+        if context is not None:
+            layout.context = context  # Shared by every clone of the base layout
+        self.context = context
+        if pathfinding is not None:
+            layout.pathfinding = pathfinding  # Routes every individual with this backend
         self.function = function
+        if batch_function is not None and 'threshold' in inspect.signature(batch_function).parameters:
+            # Staged evaluators fully score only the individuals above this percentile
+            batch_function = partial(batch_function, threshold=simulation_threshold)
+        self.batch_function = batch_function  # Scores a list of layouts at once, optional
+        # Results of layouts already scored, shared by elites, copies and repeated layouts
+        self.memo = FitnessMemo(layout, memo_size)
+        # Optional model ranking surrogate_pool times as many children as are kept
+        self.surrogate = Surrogate() if surrogate else None
+        self._base_boxes = entity_boxes(layout) if surrogate else None
+        self.surrogate_pool = surrogate_pool
         self.population_size = population_size
         self.mutation_rate = mutation_rate
         self.crossover_rate = crossover_rate
         self.simulation_threshold = simulation_threshold
         self.elite_size = elite_size
+        self.encoding = encoding  # 'layout' or 'genome'
         self.population = []
         self.generation = 0
         self.best_fitness_history = []
@@ -29,16 +132,22 @@ class GA:
         self.builder.set_astar(astar)
         
         for _ in range(self.population_size):
-            new_layout = copy.deepcopy(self.base_layout)
-            if self.builder.randomise_layout():
-                self.population.append(new_layout)
-            else:
+            new_layout = self.base_layout.clone()
+            if not new_layout.builder.randomise_layout():
                 # If we couldn't find a valid layout, use the base layout
-                self.population.append(copy.deepcopy(self.base_layout))
+                new_layout = self.base_layout.clone()
+
+            if self.encoding == 'genome':
+                self.population.append(Genome.from_layout(self.base_layout, new_layout))
+            else:
+                self.population.append(new_layout)
     
     def crossover(self, parent1, parent2):
-        """Create a child layout by crossing over two parents."""
-        child = copy.deepcopy(parent1)
+        """Create a child layout by crossing over two parents; check_child checks its paths."""
+        if self.encoding == 'genome':
+            return self.crossover_genome(parent1, parent2)
+
+        child = parent1.clone()
         child.delete_positions()
 
         auto_entities = child.auto_placed_entities
@@ -53,41 +162,145 @@ class GA:
                 entity['length'] = entity_data['length']
 
             # Get available positions that respect constraints
-            available = []
-            for pos in child.builder.get_available_positions():
-                if child.builder.is_position_valid(pos, entity):
-                    available.append(pos)
+            available = child.builder.candidate_positions(entity)
 
             if not available:
                 return parent1 if (parent1.fitness or 0) >= (parent2.fitness or 0) else parent2
 
             # Choose random valid position
-            pos = random.choice(available)
-            entity_cells = []
-            for x in range(pos[0], pos[0] + entity['width']):
-                for y in range(pos[1], pos[1] + entity['length']):
-                    entity_cells.append((x, y))
-
-            positions = {}
-            for e in entity_cells:
-                positions[str(e)[1:-1]] = entity['id']
-
-            child.add_positions(positions)
+            child.builder.place_entity(entity, random.choice(available))
 
         child.refresh_operations()
+        return child
 
-        if child.builder.has_valid_paths():
-            return child
-
-        # Fallback if no valid paths
-        return parent1 if (parent1.fitness or 0) >= (parent2.fitness or 0) else parent2
+    def crossover_genome(self, parent1, parent2):
+        """Uniform crossover of two genomes, repaired on decode."""
+        take_first = np.random.random(len(parent1.anchors)) < 0.5
+        child = Genome(
+            self.base_layout,
+            np.where(take_first, parent1.anchors, parent2.anchors),
+            np.where(take_first, parent1.orientation, parent2.orientation),
+        )
+        child.parent_route_state = parent1.route_state
+        child.parent_fitness_state = parent1.fitness_state
+        return child
 
     def mutate(self, layout):
-        return layout
+        if self.encoding != 'genome':
+            return layout
+
+        # Reset a random subset of genes to random interior cells, repaired on decode
+        mutated = np.random.random(len(layout.anchors)) < self.mutation_rate
+        if not mutated.any():
+            return layout
+
+        genome = layout.copy()
+        width = self.base_layout.width
+        length = self.base_layout.length
+        stride = self.base_layout.grid.shape[1]
+        xs = np.random.randint(1, width + 1, size=mutated.sum())
+        ys = np.random.randint(1, length + 1, size=mutated.sum())
+        genome.anchors[mutated] = xs * stride + ys
+        genome.orientation[mutated] ^= (np.random.random(mutated.sum()) < 0.5).astype(np.int8)
+        return genome
 
     def evaluate_fitness(self, layout):
         """Evaluate the fitness of a layout and return both total fitness and individual metrics."""
+        genome = None
+        if isinstance(layout, Genome):
+            genome = layout
+            layout = genome.decode()
+            if not genome.valid:
+                genome.release()
+                return -1, {}
+
+        key = self.memo.signature(layout) if self.memo.enabled else None
+        cached = self.memo.get(key) if key is not None else MISSING
+        if cached is not MISSING:
+            if genome is not None:
+                genome.release()
+            return cached[0], dict(cached[1])
+
         fitness = self.function(layout)
+        if genome is not None:
+            genome.route_state = layout.route_state
+            genome.parent_route_state = None
+            genome.fitness_state = layout.fitness_state
+            genome.parent_fitness_state = None
+            genome.release()
+        result = self._split_fitness(fitness)
+        if key is not None:
+            self.memo.put(key, result)
+        self._train_surrogate(genome if genome is not None else layout, result)
+        return result
+
+    def evaluate_population(self, population):
+        """evaluate_fitness for every individual, in one call to batch_function when it is set."""
+        if self.batch_function is None:
+            return [self.evaluate_fitness(individual) for individual in population]
+
+        results = [(-1, {})] * len(population)
+        pending = []
+        layouts = []
+        keys = []
+        scoring = {}  # Signature -> index of the individual scoring it in this batch
+        repeats = {}  # Individuals with the same layout, by the index that scores it
+        for i, individual in enumerate(population):
+            layout = individual
+            if isinstance(individual, Genome):
+                layout = individual.decode()
+                if not individual.valid:
+                    individual.release()
+                    continue
+            key = self.memo.signature(layout) if self.memo.enabled else None
+            if key is not None:
+                cached = self.memo.get(key)
+                if cached is not MISSING:
+                    results[i] = cached[0], dict(cached[1])
+                    if isinstance(individual, Genome):
+                        individual.release()
+                    continue
+                if key in scoring:
+                    repeats.setdefault(scoring[key], []).append(i)
+                    if isinstance(individual, Genome):
+                        individual.release()
+                    continue
+            pending.append(i)
+            layouts.append(layout)
+            keys.append(key)
+            if key is not None:
+                scoring[key] = i
+
+        for i, layout, key, fitness in zip(pending, layouts, keys, self.batch_function(layouts) if layouts else []):
+            genome = population[i]
+            if isinstance(genome, Genome):
+                genome.route_state = layout.route_state
+                genome.parent_route_state = None
+                genome.fitness_state = layout.fitness_state
+                genome.parent_fitness_state = None
+                genome.release()
+            results[i] = self._split_fitness(fitness)
+            if key is not None and not results[i][1].get('estimated'):
+                self.memo.put(key, results[i])
+            self._train_surrogate(population[i], results[i])
+            for j in repeats.get(i, []):
+                results[j] = results[i][0], dict(results[i][1])
+        return results
+
+    def _features(self, individual):
+        # Genomes are read from their genes, so screening a child does not decode it
+        if isinstance(individual, Genome):
+            return layout_features(self.base_layout, genome_boxes(individual, self._base_boxes), self.context)
+        return layout_features(individual, entity_boxes(individual), self.context)
+
+    def _train_surrogate(self, individual, result):
+        # Learn only from real scores of valid layouts
+        fitness, metrics = result
+        if self.surrogate is not None and fitness != -1 and not metrics.get('estimated'):
+            self.surrogate.add(self._features(individual), fitness)
+
+    @staticmethod
+    def _split_fitness(fitness):
         if fitness is None:
             return -1, {}
         
@@ -107,8 +320,8 @@ class GA:
         
         # Evaluate all layouts
         scored_population = []
-        for layout in self.population:
-            fitness, metrics = self.evaluate_fitness(layout)
+        for layout, (fitness, metrics) in zip(self.population, self.evaluate_population(self.population)):
+            layout.fitness = fitness
             scored_population.append((layout, fitness))
             self.current_generation_metrics.append(metrics)
         
@@ -131,34 +344,67 @@ class GA:
         print('Best Fitness is', best_fitness)
         
         # Fill rest of population
-        while len(new_population) < self.population_size:
-            # Select parents using tournament selection
-            tournament_size = 3
-            tournament = random.sample(scored_population, tournament_size)
-            parent1 = max(tournament, key=lambda x: x[1])[0]
-            
-            tournament = random.sample(scored_population, tournament_size)
-            parent2 = max(tournament, key=lambda x: x[1])[0]
-            
-            # Crossover
-            if random.random() < self.crossover_rate:
-                child = self.crossover(parent1, parent2)
-            else:
-                child = copy.deepcopy(parent1)
-            
-            # Mutation
-            self.mutate(child)
-            
-            new_population.append(child)
+        needed = self.population_size - len(new_population)
+        pool = needed
+        if self.surrogate is not None and self.surrogate.ready:
+            # Breed more children than needed and keep the ones the surrogate ranks best
+            pool = needed * self.surrogate_pool
+        bred = [self.breed(scored_population) for _ in range(pool)]
+        if pool > needed:
+            bred = [bred[i] for i in self.screen([child for child, _ in bred], needed)]
+        # Only the children kept are decoded and checked for valid paths
+        new_population.extend(self.check_child(child, fallback) for child, fallback in bred)
         
         self.population = new_population
         self.generation += 1
 
+    def breed(self, scored_population):
+        """One child from two tournament-selected parents, with the parent check_child falls back to."""
+        # Select parents using tournament selection
+        tournament_size = 3
+        tournament = random.sample(scored_population, tournament_size)
+        parent1 = max(tournament, key=lambda x: x[1])[0]
+        
+        tournament = random.sample(scored_population, tournament_size)
+        parent2 = max(tournament, key=lambda x: x[1])[0]
+        
+        # Crossover
+        fallback = None
+        if random.random() < self.crossover_rate:
+            child = self.crossover(parent1, parent2)
+            fallback = parent1 if (parent1.fitness or 0) >= (parent2.fitness or 0) else parent2
+        else:
+            child = parent1.copy() if self.encoding == 'genome' else parent1.clone()
+        
+        # Mutation
+        return self.mutate(child), fallback
+
+    def check_child(self, child, fallback):
+        """child if it decodes and has valid paths, else the fallback parent."""
+        if fallback is None or child is fallback:
+            return child
+        layout = child
+        if isinstance(child, Genome):
+            layout = child.decode()
+            if not child.valid:
+                return fallback
+        if layout.builder.has_valid_paths():
+            return child
+
+        # Fallback if no valid paths
+        return fallback
+
+    def screen(self, children, n):
+        """Indices of the n children with the highest surrogate-predicted fitness, in order."""
+        predicted = self.surrogate.predict([self._features(child) for child in children])
+        return sorted(np.argsort(-predicted, kind='stable')[:n])
+
     def best_layouts(self, n=3):
         """Get the best n layouts from the current population."""
-        scored_population = [(layout, self.evaluate_fitness(layout)) for layout in self.population]
-        scored_population.sort(key=lambda x: x[1], reverse=True)
-        return [layout for layout, score in scored_population[:n]]
+        scored_population = list(zip(self.population, self.evaluate_population(self.population)))
+        scored_population.sort(key=lambda x: x[1][0], reverse=True)
+        return [layout.decode() if isinstance(layout, Genome) else layout
+                for layout, score in scored_population[:n]]
 
     def get_fitness_metrics(self):
         """Return the fitness metrics for all generations."""
@@ -175,6 +421,7 @@ class GA:
         for i in range(25):  # 20 generations
             self.evolve()
             print(f"Generation {i+1} done.")
+        print('Fitness memo:', self.memo.stats())
 
         best_layouts = self.best_layouts()
         
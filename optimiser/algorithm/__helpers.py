@@ -1,25 +1,77 @@
+import heapq
+from collections import Counter
+import numpy as np
+from models import FREE, WALL
+from .path_cache import path_cache, MISSING
+
+# Neighbour order used when expanding and back-tracing on distance fields
+MOVES = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+
+# population_operation_routes keeps about 20 bytes per cell of every stacked
+# distance field; batches of layouts keep that under ~40MB
+MAX_BATCH_CELLS = 1 << 21
+
 def manhattan_distance(pos1, pos2):
     """Calculate Manhattan distance between two points."""
     return abs(pos1[0] - pos2[0]) + abs(pos1[1] - pos2[1])
 
-def get_neighbors(pos, layout, aisle_width=1):
-    """Get valid neighboring positions."""
+def get_neighbors(pos, layout, aisle_width=1, sources=frozenset(), goals=frozenset()):
+    """Get valid neighboring positions.
+
+    Free cells are valid, and so are the cells of the source and goal
+    footprints. With aisle_width > 1 a free cell must also be wide enough for
+    the vehicle (Layout.wide_mask), unless it is a docking cell: the first
+    cell after the source, or a cell next to the goal. A narrow docking cell
+    next to the goal only leads on into the goal.
+    """
     x, y = pos
+    rows = layout.grid_rows
+    wide = layout.wide_rows(aisle_width) if aisle_width > 1 else None
+    if (wide is not None and rows[x][y] == FREE and not wide[x][y]
+            and pos not in sources and not _touches(pos, sources)):
+        return [(x + dx, y + dy) for dx, dy in MOVES if (x + dx, y + dy) in goals]
+
+    leaving = pos in sources
     neighbors = []
     
     # Check all four directions
-    for dx, dy in [(0,1), (0,-1), (1,0), (-1,0)]:
+    for dx, dy in MOVES:
         new_x, new_y = x + dx, y + dy
-        new_pos = (new_x, new_y)
         
-        # Check if position is within bounds and not a wall
-        if (1 <= new_x <= layout.width and 
-            1 <= new_y <= layout.length and 
-            new_pos not in layout.structure.get('wall', [])):
-            neighbors.append(new_pos)
+        # Check if position is within bounds and not a wall or another entity
+        if 1 <= new_x <= layout.width and 1 <= new_y <= layout.length:
+            neighbor = (new_x, new_y)
+            if neighbor in sources or neighbor in goals:
+                neighbors.append(neighbor)
+            elif rows[new_x][new_y] == FREE and (wide is None or wide[new_x][new_y]
+                                                 or leaving or _touches(neighbor, goals)):
+                neighbors.append(neighbor)
     
     return neighbors
 
+def _touches(cell, cells):
+    x, y = cell
+    return any((x + dx, y + dy) in cells for dx, dy in MOVES)
+
+def endpoint_cells(layout, *cells):
+    """cells plus every cell of the entities occupying them."""
+    rows = layout.grid_rows
+    result = {(c[0], c[1]) for c in cells}
+    for value in {rows[x][y] for x, y in result}:
+        if value >= 0:
+            result.update((p[0], p[1]) for p in layout.entities[value]['positions'])
+    return frozenset(result)
+
+def _cached_path(key):
+    cached = path_cache.get(key)
+    if cached is MISSING:
+        return MISSING
+    return list(cached) if cached is not None else None
+
+def _store_path(key, path):
+    path_cache.put(key, tuple(path) if path is not None else None)
+    return path
+
 def astar(start_, goal_, layout, aisle_width=1):
     """A* pathfinding algorithm."""
     if not start_ or not goal_:
@@ -28,14 +80,25 @@ def astar(start_, goal_, layout, aisle_width=1):
     # Initialize data structures
     start = (start_[0], start_[1])
     goal = (goal_[0], goal_[1])
-    open_set = {start}
+    key = ('astar', layout.grid_key, start, goal, aisle_width)
+    cached = _cached_path(key)
+    if cached is not MISSING:
+        return cached
+    return _store_path(key, _astar(start, goal, layout, aisle_width))
+
+def _astar(start, goal, layout, aisle_width):
+    sources = endpoint_cells(layout, start)
+    goals = endpoint_cells(layout, goal)
+    open_heap = [(manhattan_distance(start, goal), 0, start)]
     came_from = {}
     g_score = {start: 0}
-    f_score = {start: manhattan_distance(start, goal)}
+    closed = set()
     
-    while open_set:
+    while open_heap:
         # Get node with lowest f_score
-        current = min(open_set, key=lambda pos: f_score.get(pos, float('inf')))
+        _, current_g, current = heapq.heappop(open_heap)
+        if current in closed:
+            continue
         
         if current == goal:
             # Reconstruct path
@@ -47,16 +110,367 @@ def astar(start_, goal_, layout, aisle_width=1):
             path.reverse()
             return path
             
-        open_set.remove(current)
+        closed.add(current)
         
         # Check neighbors
-        for neighbor in get_neighbors(current, layout, aisle_width):
-            tentative_g_score = g_score[current] + 1
+        for neighbor in get_neighbors(current, layout, aisle_width, sources, goals):
+            if neighbor in closed:
+                continue
+            tentative_g_score = current_g + 1
             
             if tentative_g_score < g_score.get(neighbor, float('inf')):
                 came_from[neighbor] = current
                 g_score[neighbor] = tentative_g_score
-                f_score[neighbor] = tentative_g_score + manhattan_distance(neighbor, goal)
-                open_set.add(neighbor)
+                heapq.heappush(open_heap, (tentative_g_score + manhattan_distance(neighbor, goal), tentative_g_score, neighbor))
                 
-    return None  # No path found 
\ No newline at end of file
+    return None  # No path found
+
+def distance_field(cells, layout, aisle_width=1, targets=None):
+    """Breadth-first distances from every cell of a footprint.
+
+    Free cells are expanded; cells of other entities get a distance (a route
+    may end there) but are never expanded through. If targets (entity ids)
+    is given, the search stops after the level on which the last of them
+    is reached. Aisle widths follow get_neighbors, with every target (every
+    entity if targets is None) counting as a goal for docking cells.
+    """
+    rows = layout.grid_rows
+    width, length = layout.width, layout.length
+    wide = layout.wide_rows(aisle_width) if aisle_width > 1 else None
+    sources = sorted({(c[0], c[1]) for c in cells})
+    dist = dict.fromkeys(sources, 0)
+    remaining = set(targets) if targets is not None else None
+
+    def docks(x, y):
+        # A narrow free cell may be entered when it lies next to a target
+        for dx, dy in MOVES:
+            value = rows[x + dx][y + dy]
+            if value >= 0 and (targets is None or value in targets):
+                return True
+        return False
+
+    frontier = sources
+    d = 0
+    while frontier and (remaining is None or remaining):
+        d += 1
+        next_frontier = []
+        for x, y in frontier:
+            # Narrow cells past the first level are docking cells: only entities lie beyond
+            enclosed = wide is not None and d > 2 and not wide[x][y]
+            for dx, dy in MOVES:
+                nx, ny = x + dx, y + dy
+                if (nx, ny) in dist or not (1 <= nx <= width and 1 <= ny <= length):
+                    continue
+                value = rows[nx][ny]
+                if value == WALL:
+                    continue
+                if value == FREE:
+                    if enclosed or not (wide is None or d == 1 or wide[nx][ny] or docks(nx, ny)):
+                        continue
+                    dist[(nx, ny)] = d
+                    next_frontier.append((nx, ny))
+                else:
+                    dist[(nx, ny)] = d
+                    if remaining is not None:
+                        remaining.discard(value)
+        frontier = next_frontier
+
+    return dist
+
+def trace_route(dist, cell, layout, aisle_width=1):
+    """Walk down a distance field from cell to its source footprint.
+
+    Returns the cells from cell (inclusive) to a source cell (inclusive).
+    """
+    rows = layout.grid_rows
+    wide = layout.wide_rows(aisle_width) if aisle_width > 1 else None
+    path = [cell]
+    x, y = cell
+    d = dist[cell]
+    while d > 0:
+        for dx, dy in MOVES:
+            nx, ny = x + dx, y + dy
+            # Steps go through free cells only, apart from the final source cell;
+            # a narrow docking cell can only be the first or the last of them
+            if dist.get((nx, ny)) == d - 1 and (d == 1 or (
+                    rows[nx][ny] == FREE and (wide is None or len(path) == 1 or d == 2 or wide[nx][ny]))):
+                x, y, d = nx, ny, d - 1
+                path.append((x, y))
+                break
+        else:
+            return None
+    return path
+
+def closest_cell(dist, cells):
+    """Cell of a footprint nearest to the field source, ties broken by position."""
+    reached = [(dist[c], c) for c in {(p[0], p[1]) for p in cells} if c in dist]
+    return min(reached)[1] if reached else None
+
+def operation_routes(layout, aisle_width=1):
+    """Shortest route for every operation, using one distance field per entity.
+
+    Each operation is routed from the field of whichever endpoint takes part
+    in more operations, so the number of searches scales with the number of
+    distinct entities rather than the number of operations. Routes run from
+    the from_entity to the to_entity. Returns None if any operation has no
+    route.
+    """
+    key = operations_key(layout, aisle_width)
+    cached = path_cache.get(key)
+    if cached is not MISSING:
+        return [list(route) for route in cached] if cached is not None else None
+
+    routes = _operation_routes(layout, aisle_width)
+    path_cache.put(key, tuple(tuple(route) for route in routes) if routes is not None else None)
+    return routes
+
+def operations_key(layout, aisle_width, kind='operations'):
+    """path_cache key of the routes of every operation of layout.
+
+    The grid holds every footprint, so it and the endpoint ids fix the
+    result. kind tells apart backends whose routes may differ.
+    """
+    return (kind, layout.grid_key, aisle_width,
+            tuple((int(op['from_entity']['id']), int(op['to_entity']['id'])) for op in layout.operations))
+
+def operation_roots(operations):
+    """Root entity of each operation and the entities each root is routed to.
+
+    operations are (from id, to id) pairs. An operation is rooted at the
+    endpoint taking part in more operations, the from_entity on a tie.
+    """
+    counts = Counter()
+    for from_id, to_id in operations:
+        counts[from_id] += 1
+        counts[to_id] += 1
+    roots = [to_id if counts[to_id] > counts[from_id] else from_id for from_id, to_id in operations]
+    targets = {}
+    for root, (from_id, to_id) in zip(roots, operations):
+        targets.setdefault(root, set()).add(from_id + to_id - root)
+    return roots, targets
+
+def _operation_routes(layout, aisle_width):
+    plan, targets = operation_roots([(int(op['from_entity']['id']), int(op['to_entity']['id']))
+                                     for op in layout.operations])
+
+    fields = {}
+    routes = []
+    for op, root in zip(layout.operations, plan):
+        from_entity, to_entity = op['from_entity'], op['to_entity']
+        if not from_entity['positions'] or not to_entity['positions']:
+            return None
+        root_entity, other = (from_entity, to_entity) if root == int(from_entity['id']) else (to_entity, from_entity)
+        if root not in fields:
+            fields[root] = distance_field(root_entity['positions'], layout, aisle_width, targets[root])
+        dist = fields[root]
+
+        goal = closest_cell(dist, other['positions'])
+        if goal is None:
+            return None
+        path = trace_route(dist, goal, layout, aisle_width)
+        if path is None:
+            return None
+        if root_entity is from_entity:
+            path.reverse()
+        routes.append(path)
+
+    return routes
+
+def population_operation_routes(layouts):
+    """operation_routes for many layouts at once.
+
+    Layouts of the same shape and aisle width are stacked, and the distance
+    fields of all their roots grow together as one 3D wavefront; the routes
+    are then traced down all fields in lock-step. Returns, for each layout,
+    exactly the routes operation_routes gives (or None), sharing its cache.
+    """
+    results = [None] * len(layouts)
+    groups = {}
+    for i, layout in enumerate(layouts):
+        key = operations_key(layout, layout.aisle_width)
+        cached = path_cache.get(key)
+        if cached is not MISSING:
+            results[i] = [list(route) for route in cached] if cached is not None else None
+            continue
+        groups.setdefault((layout.grid.shape, layout.aisle_width), []).append((i, key))
+
+    for (shape, aisle_width), members in groups.items():
+        for batch in _field_batches(layouts, members, shape[0] * shape[1]):
+            routes = _population_routes([layouts[i] for i, _ in batch], aisle_width)
+            for (i, key), layout_routes in zip(batch, routes):
+                path_cache.put(key, tuple(tuple(route) for route in layout_routes) if layout_routes is not None else None)
+                results[i] = layout_routes
+    return results
+
+def _field_batches(layouts, members, cells):
+    # Runs of members whose stacked fields hold at most MAX_BATCH_CELLS cells, one layout at least
+    batch, total = [], 0
+    for member in members:
+        operations = [(int(op['from_entity']['id']), int(op['to_entity']['id']))
+                      for op in layouts[member[0]].operations]
+        size = len(operation_roots(operations)[1]) * cells
+        if batch and total + size > MAX_BATCH_CELLS:
+            yield batch
+            batch, total = [], 0
+        batch.append(member)
+        total += size
+    if batch:
+        yield batch
+
+def _shift_or(mask):
+    # Cells one 4-connected step from any True cell of every slice
+    out = np.zeros_like(mask)
+    out[:, 1:, :] |= mask[:, :-1, :]
+    out[:, :-1, :] |= mask[:, 1:, :]
+    out[:, :, 1:] |= mask[:, :, :-1]
+    out[:, :, :-1] |= mask[:, :, 1:]
+    return out
+
+def _population_routes(layouts, aisle_width):
+    grids = np.stack([layout.grid for layout in layouts])
+    shape = grids.shape[1:]
+    n_entities = int(grids.max()) + 1 if grids.size else 0
+
+    # One field per (layout, root), rooted as in _operation_routes
+    fields = []      # (layout index, root id, target ids)
+    plans = []       # per layout: [(field index, other id, root is from_entity)] or None
+    for li, layout in enumerate(layouts):
+        operations = [(int(op['from_entity']['id']), int(op['to_entity']['id'])) for op in layout.operations]
+        roots = {}
+        plan = []
+        for op, (from_id, to_id), root in zip(layout.operations, operations, operation_roots(operations)[0]):
+            if not op['from_entity']['positions'] or not op['to_entity']['positions']:
+                plan = None
+                break
+            if root not in roots:
+                roots[root] = len(fields)
+                fields.append((li, root, set()))
+            other = from_id if root == to_id else to_id
+            fields[roots[root]][2].add(other)
+            plan.append((roots[root], other, root == from_id))
+        plans.append(plan)
+
+    if not fields:
+        return [None if plan is None else [] for plan in plans]
+
+    owner = np.array([li for li, _, _ in fields])
+    slices = grids[owner]
+    free = slices == FREE
+    entity = slices >= 0
+    dist = np.full(slices.shape, -1, dtype=np.int32)
+    sources = slices == np.array([root for _, root, _ in fields])[:, None, None]
+    dist[sources] = 0
+
+    targets = np.zeros((len(fields), max(n_entities, 1)), dtype=bool)
+    for f, (_, _, others) in enumerate(fields):
+        targets[f, list(others)] = True
+    if aisle_width > 1:
+        wide = np.stack([layout.wide_mask(aisle_width) for layout in layouts])[owner]
+        # Narrow free cells next to a target may end a route there
+        target_cells = entity & targets[np.arange(len(fields))[:, None, None], np.where(entity, slices, 0)]
+        docks = free & ~wide & _shift_or(target_cells)
+    reached = np.zeros_like(targets)
+
+    # The wavefront is kept as flat indices into the stacked fields, so each
+    # level only touches the cells it reaches; the border wall keeps every
+    # step inside its own field
+    size = shape[0] * shape[1]
+    codes = slices.ravel()
+    flat_dist = dist.ravel()
+    flat_free = free.ravel()
+    if aisle_width > 1:
+        flat_wide = wide.ravel()
+        usable = (wide | docks).ravel()
+    steps = np.array([dx * shape[1] + dy for dx, dy in MOVES])
+
+    frontier = np.flatnonzero(sources)
+    d = 0
+    while len(frontier):
+        d += 1
+        movers = frontier
+        if aisle_width > 1 and d > 2:
+            # Narrow cells past the first level are docking cells: only entities lie beyond
+            movers = frontier[flat_wide[frontier]]
+        around = (frontier[:, None] + steps).ravel()
+        new = np.unique(around[(codes[around] >= 0) & (flat_dist[around] < 0)])
+        around = (movers[:, None] + steps).ravel()
+        keep = flat_free[around] & (flat_dist[around] < 0)
+        if aisle_width > 1 and d > 1:
+            keep &= usable[around]
+        into_free = np.unique(around[keep])
+        flat_dist[new] = d
+        flat_dist[into_free] = d
+
+        reached[new // size, codes[new]] = True
+        # A field stops after the level on which its last target is reached
+        done = ~(targets & ~reached).any(axis=1)
+        frontier = into_free[~done[into_free // size]]
+
+    # Goal cell of every route: the nearest cell of the other endpoint
+    route_fields, goals, flips, owners = [], [], [], []
+    for li, plan in enumerate(plans):
+        if plan is None:
+            continue
+        for f, other, root_is_from in plan:
+            cells = np.array([(p[0], p[1]) for p in layouts[li].entities[other]['positions']])
+            d_cells = dist[f, cells[:, 0], cells[:, 1]]
+            ok = d_cells >= 0
+            if not ok.any():
+                plans[li] = None
+                break
+            cells, d_cells = cells[ok], d_cells[ok]
+            best = np.lexsort((cells[:, 1], cells[:, 0], d_cells))[0]
+            route_fields.append(f)
+            goals.append(cells[best])
+            flips.append(root_is_from)
+            owners.append(li)
+
+    paths = _trace_routes(dist, free, wide if aisle_width > 1 else None,
+                          np.array(route_fields, dtype=np.int64), np.array(goals).reshape(-1, 2))
+
+    results = [None if plan is None else [] for plan in plans]
+    for path, flip, li in zip(paths, flips, owners):
+        if plans[li] is None:
+            continue
+        if path is None:
+            plans[li] = None
+            results[li] = None
+            continue
+        if flip:
+            path.reverse()
+        results[li].append(path)
+    return results
+
+def _trace_routes(dist, free, wide, fields, goals):
+    """trace_route down many fields at once, with the same choice of steps."""
+    if not len(fields):
+        return []
+    n = len(fields)
+    cur = goals.copy()
+    d = dist[fields, cur[:, 0], cur[:, 1]]
+    length = d + 1
+    cells = np.zeros((n, int(length.max()), 2), dtype=np.int64)
+    cells[:, 0] = cur
+    failed = np.zeros(n, dtype=bool)
+    moves = np.array(MOVES)
+    for step in range(1, int(length.max())):
+        active = np.flatnonzero(d > 0)
+        if not len(active):
+            break
+        candidates = cur[active, None, :] + moves[None, :, :]
+        cx, cy = candidates[..., 0], candidates[..., 1]
+        field = fields[active, None]
+        left = d[active]
+        valid = dist[field, cx, cy] == (left - 1)[:, None]
+        passable = free[field, cx, cy]
+        if wide is not None:
+            # A narrow docking cell can only be the first or the last of the steps
+            passable &= (step == 1) | (left == 2)[:, None] | wide[field, cx, cy]
+        valid &= (left == 1)[:, None] | passable
+        found = valid.any(axis=1)
+        failed[active[~found]] = True
+        moving = active[found]
+        cur[moving] = candidates[found, valid[found].argmax(axis=1)]
+        d[moving] -= 1
+        cells[moving, step] = cur[moving]
+    return [None if failed[i] else list(map(tuple, cells[i, :length[i]].tolist())) for i in range(n)]
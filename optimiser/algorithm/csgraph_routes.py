@@ -0,0 +1,175 @@
+import numpy as np
+from models import FREE, WALL
+from .__helpers import MOVES, closest_cell, operation_roots, operations_key, trace_route, operation_routes as python_operation_routes
+from .path_cache import path_cache, MISSING
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse import csgraph
+except ImportError:  # routing falls back to the pure-Python distance fields
+    csgraph = None
+
+# Dijkstra returns a dense row per source; batches keep that under ~32MB
+MAX_BATCH_CELLS = 1 << 22
+
+def operation_routes(layout, aisle_width=1):
+    """Shortest route for every operation from one compiled multi-source search.
+
+    Drop-in replacement for __helpers.operation_routes: the same root
+    choice and aisle rules, and the routes are traced down the distance
+    rows with trace_route, so they are the same routes. Falls back to it
+    when SciPy is not installed.
+    """
+    if csgraph is None:
+        return python_operation_routes(layout, aisle_width)
+
+    key = operations_key(layout, aisle_width, 'operations-csgraph')
+    cached = path_cache.get(key)
+    if cached is not MISSING:
+        return [list(route) for route in cached] if cached is not None else None
+
+    routes = _operation_routes(layout, aisle_width)
+    path_cache.put(key, tuple(tuple(route) for route in routes) if routes is not None else None)
+    return routes
+
+def _operation_routes(layout, aisle_width):
+    if any(not op['from_entity']['positions'] or not op['to_entity']['positions'] for op in layout.operations):
+        return None
+    operations = [(int(op['from_entity']['id']), int(op['to_entity']['id'])) for op in layout.operations]
+    plan = operation_roots(operations)[0]
+
+    graph = RouteGraph(layout, aisle_width, sorted(set(plan)))
+    dist = graph.search()
+
+    routes = []
+    for root, (from_id, to_id) in zip(plan, operations):
+        path = graph.route(dist, root, from_id + to_id - root)
+        if path is None:
+            return None
+        if root == to_id:
+            path.reverse()
+        routes.append(path)
+    return routes
+
+class RouteGraph:
+    """Directed cell graph of a layout as a sparse matrix.
+
+    Nodes are the flat indices of layout.grid plus one source node per root
+    entity, joined to the cells just outside its footprint. Edges follow the
+    4-connected rules of get_neighbors: routes run over free cells, end on
+    an entity cell, and on wider aisles use a narrow cell only as the first
+    cell after the source or the last one before the goal.
+    """
+    def __init__(self, layout, aisle_width, roots):
+        self.layout = layout
+        self.aisle_width = aisle_width
+        self.stride = layout.grid.shape[1]
+        self.cells = layout.grid.size
+        self.roots = {root: self.cells + i for i, root in enumerate(roots)}
+
+        grid = layout.grid
+        free = grid == FREE
+        entity = grid >= 0
+        open_ = free
+        if aisle_width > 1:
+            open_ = layout.wide_mask(aisle_width)
+
+        # A narrow cell beside an entity is a docking cell for it
+        beside_entity = np.zeros_like(entity)
+        for dx, dy in MOVES:
+            beside_entity[1:-1, 1:-1] |= entity[1 + dx:grid.shape[0] - 1 + dx, 1 + dy:grid.shape[1] - 1 + dy]
+        dock = free & ~open_ & beside_entity
+
+        index = np.arange(self.cells).reshape(grid.shape)
+        rows, cols = [], []
+        inner = (slice(1, -1), slice(1, -1))
+        for dx, dy in MOVES:
+            moved = (slice(1 + dx, grid.shape[0] - 1 + dx), slice(1 + dy, grid.shape[1] - 1 + dy))
+            allowed = ((open_[inner] & (open_[moved] | entity[moved] | dock[moved]))
+                       | (dock[inner] & entity[moved]))
+            rows.append(index[inner][allowed])
+            cols.append(index[moved][allowed])
+        rows = [np.concatenate(rows)]
+        cols = [np.concatenate(cols)]
+        weights = [np.ones(len(rows[0]))]
+
+        cell_rows = layout.grid_rows
+        source_rows, source_cols, source_weights = [], [], []
+        for root, node in self.roots.items():
+            footprint = {(p[0], p[1]) for p in layout.entities[root]['positions']}
+            for cell, cost in self._exits(footprint, cell_rows, open_, dock).items():
+                source_rows.append(node)
+                source_cols.append(cell[0] * self.stride + cell[1])
+                source_weights.append(cost)
+        rows.append(np.array(source_rows, dtype=np.int64))
+        cols.append(np.array(source_cols, dtype=np.int64))
+        weights.append(np.array(source_weights, dtype=float))
+
+        size = self.cells + len(self.roots)
+        self.matrix = csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(size, size))
+
+    @staticmethod
+    def _exits(footprint, rows, open_, dock):
+        # Cells one or (through a narrow docking cell) two steps out of the footprint
+        exits = {}
+        for x, y in footprint:
+            for dx, dy in MOVES:
+                cell = (x + dx, y + dy)
+                if cell in footprint or rows[cell[0]][cell[1]] == WALL:
+                    continue
+                exits[cell] = 1
+                if rows[cell[0]][cell[1]] == FREE and not open_[cell]:
+                    for ex, ey in MOVES:
+                        beyond = (cell[0] + ex, cell[1] + ey)
+                        if beyond not in footprint and beyond not in exits and (open_[beyond] or dock[beyond]):
+                            exits[beyond] = 2
+        return exits
+
+    def search(self):
+        """Distances from every root, in as few Dijkstra calls as fit in memory."""
+        nodes = list(self.roots.values())
+        batch = max(1, MAX_BATCH_CELLS // self.matrix.shape[0])
+        return np.concatenate([csgraph.dijkstra(self.matrix, indices=nodes[start:start + batch])
+                               for start in range(0, len(nodes), batch)])
+
+    def route(self, dist, root, other):
+        """Cells from a cell of root to the nearest cell of other, or None.
+
+        The route is traced down root's row of dist as trace_route traces
+        it down a distance_field, so steps and ties follow MOVES and the
+        goal is the closest_cell of other.
+        """
+        field = DistanceRow(dist[self.roots[root] - self.cells], self.stride,
+                            self.layout.entities[root]['positions'])
+        goal = closest_cell(field, self.layout.entities[other]['positions'])
+        if goal is None:
+            return None
+        path = trace_route(field, goal, self.layout, self.aisle_width)
+        return path[::-1] if path is not None else None
+
+class DistanceRow:
+    """One row of RouteGraph.search distances, read like a distance_field.
+
+    Maps cells to distances, with the root footprint at 0 and unreachable
+    cells missing.
+    """
+    def __init__(self, row, stride, footprint):
+        self.values = row.tolist()
+        self.stride = stride
+        self.footprint = {(p[0], p[1]) for p in footprint}
+
+    def get(self, cell, default=None):
+        if cell in self.footprint:
+            return 0
+        d = self.values[cell[0] * self.stride + cell[1]]
+        return default if d == np.inf else int(d)
+
+    def __getitem__(self, cell):
+        d = self.get(cell)
+        if d is None:
+            raise KeyError(cell)
+        return d
+
+    def __contains__(self, cell):
+        return self.get(cell) is not None
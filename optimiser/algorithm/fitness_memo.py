@@ -0,0 +1,102 @@
+import hashlib
+from collections import OrderedDict
+from .path_cache import MISSING
+
+class FitnessMemo:
+    """Bounded LRU cache of fitness results, keyed by a canonical layout signature.
+
+    Elites, unchanged copies and crossover fallbacks are the same layout
+    evaluated again. The signature lists the footprints of the auto-placed
+    entities with interchangeable entities (same spec and the same part in
+    the operations, as add_entities creates them from a quantity) sorted
+    together, so layouts that only swap such entities share an entry. At
+    most max_entries results are kept; max_entries=0 disables the memo.
+    """
+    def __init__(self, base, max_entries=4096):
+        self.max_entries = max_entries
+        self.classes = interchangeable_entities(base)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def signature(self, layout):
+        """Digest of the placement of layout's auto-placed entities, up to interchangeable ones."""
+        parts = [layout.aisle_width]
+        for members in self.classes:
+            parts.append(tuple(sorted(tuple(sorted((p[0], p[1]) for p in layout.entities[i]['positions']))
+                                      for i in members)))
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).digest()
+
+    def get(self, key, default=MISSING):
+        """Cached result for key, or default if absent."""
+        entry = self._entries.get(key, MISSING)
+        if entry is MISSING:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+def interchangeable_entities(layout):
+    """Auto-placed entity indices grouped into classes that can swap places without changing fitness.
+
+    Entities are interchangeable when they share category, type, footprint
+    size, utility needs and zone, and take part in the same operations (by
+    role, partner and frequency).
+    """
+    roles = {}
+    for op in layout.operations:
+        from_id = int(op['from_entity']['id'])
+        to_id = int(op['to_entity']['id'])
+        frequency = op.get('frequency')
+        roles.setdefault(from_id, []).append(('from', to_id, frequency))
+        roles.setdefault(to_id, []).append(('to', from_id, frequency))
+
+    classes = {}
+    for index, entity in enumerate(layout.entities):
+        if entity['placement'] != 'auto':
+            continue
+        depends_on = entity.get('depends_on')
+        key = (
+            entity.get('category'),
+            entity.get('type'),
+            tuple(sorted((entity['width'], entity['length']))),
+            tuple(depends_on) if isinstance(depends_on, list) else depends_on,
+            entity.get('within_zone'),
+            tuple(sorted(roles.get(index, []), key=repr)),
+        )
+        classes.setdefault(key, []).append(index)
+    return list(classes.values())
@@ -0,0 +1,86 @@
+import sys
+from collections import OrderedDict
+
+# Returned by PathCache.get when a key is absent (None is a valid cached result)
+MISSING = object()
+
+class PathCache:
+    """Bounded LRU cache of search results, shared across generations.
+
+    Keys combine a hash of the obstacle grid with the query endpoints, so a
+    layout that is carried over unchanged (an elite) or that shares its grid
+    with an earlier individual reuses the earlier routes. The cache holds at
+    most max_bytes of (estimated) route data and evicts least recently used
+    entries first; max_bytes=0 disables it.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        """Cached value for key, or default if absent."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        if self.max_bytes <= 0:
+            return
+        size = _estimate_size(value)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old[1]
+        self._entries[key] = (value, size)
+        self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._entries and self._size > self.max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._size,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+def _estimate_size(value):
+    """Rough memory footprint of a cached route or list of routes."""
+    if value is None:
+        return 64
+    if value and isinstance(value[0], (tuple, list)) and value[0] and isinstance(value[0][0], (tuple, list)):
+        return sys.getsizeof(value) + sum(_estimate_size(route) for route in value)
+    # A route: the container plus one 2-tuple of small ints per cell
+    return sys.getsizeof(value) + 64 * len(value)
+
+# Module-wide cache consulted by the path search helpers
+path_cache = PathCache()
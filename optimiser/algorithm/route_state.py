@@ -0,0 +1,309 @@
+from itertools import chain
+import numpy as np
+from models import FREE, WALL
+from .__helpers import MOVES, closest_cell, distance_field, operation_roots, trace_route
+
+INF = float('inf')
+
+def field_level(dist, layout, targets):
+    """Level up to which a distance_field is complete: the level on which its
+    last target was reached, or INF if a target is out of reach.
+
+    The field's own footprint is never reached, so a search targeting it
+    covers everything it can reach.
+    """
+    if _unreached(dist, layout, targets):
+        return INF
+    return max(dist.values())
+
+def repair_field(dist, level, cells, layout, aisle_width, targets, changed):
+    """Bring a distance_field up to date after the cells in changed.
+
+    dist is the field of the footprint cells on an earlier grid, complete up
+    to level (see field_level), and changed lists every cell whose occupancy
+    or width for the vehicle differs since. Cells whose distance lost its
+    support are cleared, the gaps refilled from their intact neighbours, and
+    the search carried on past level if a target is no longer reached by
+    then. Returns (dist, level, touched), touched being the cells whose
+    distance changed, or None if the changes were too many to repair and
+    the field was searched afresh; dist is a new dict unless touched is empty, so the
+    earlier field stays as it was. Up to the returned level the field equals
+    distance_field on the current grid.
+    """
+    if len(changed) * 24 > len(dist):
+        # Each change costs a few neighbour checks: past this many, searching afresh is cheaper
+        dist = distance_field(cells, layout, aisle_width, targets)
+        return dist, field_level(dist, layout, targets), None
+
+    rows = layout.grid_rows
+    width, length = layout.width, layout.length
+    wide = layout.wide_rows(aisle_width) if aisle_width > 1 else None
+    sources = {(c[0], c[1]) for c in cells}
+    # Free cells next to the footprint, which are always entered and expanded
+    ring = {(x + dx, y + dy) for x, y in sources for dx, dy in MOVES} - sources
+
+    def admits(x, y):
+        # Whether distance_field gives the cell a distance when it reaches it
+        if not (1 <= x <= width and 1 <= y <= length) or (x, y) in sources:
+            return False
+        value = rows[x][y]
+        if value == WALL:
+            return False
+        if value != FREE or wide is None or wide[x][y] or (x, y) in ring:
+            return True
+        for dx, dy in MOVES:
+            if rows[x + dx][y + dy] in targets:
+                return True
+        return False
+
+    def steps(x, y, nx, ny):
+        # Whether distance_field expands (x, y) into its admitted neighbour (nx, ny)
+        if (x, y) in sources:
+            return True
+        if rows[x][y] != FREE:
+            return False
+        return wide is None or rows[nx][ny] >= 0 or wide[x][y] or (x, y) in ring
+
+    def best_from(x, y, known):
+        # Lowest distance (x, y) gets from a neighbour in known, INF if none
+        best = INF
+        for dx, dy in MOVES:
+            d = known.get((x + dx, y + dy))
+            if d is not None and d + 1 < best and steps(x + dx, y + dy, x, y):
+                best = d + 1
+        return best
+
+    # Clear, level by level, every cell no longer reached from an intact cell one level down
+    around = set(changed)
+    for x, y in changed:
+        for dx, dy in MOVES:
+            around.add((x + dx, y + dy))
+    pending = {}
+    for cell in around:
+        d = dist.get(cell)
+        if d:
+            pending.setdefault(d, []).append(cell)
+    cleared = set()
+
+    def supported(x, y, d):
+        # Whether an intact neighbour one level down still expands into (x, y)
+        for dx, dy in MOVES:
+            u = (x + dx, y + dy)
+            if dist.get(u) == d - 1 and u not in cleared and steps(u[0], u[1], x, y):
+                return True
+        return False
+
+    d = min(pending, default=0)
+    while pending:
+        for x, y in pending.pop(d, ()):
+            if (x, y) in cleared:
+                continue
+            if admits(x, y) and supported(x, y, d):
+                continue
+            cleared.add((x, y))
+            if len(cleared) > len(dist) // 16:
+                # Much of the field is lost: searching afresh is cheaper than refilling it
+                dist = distance_field(cells, layout, aisle_width, targets)
+                return dist, field_level(dist, layout, targets), None
+            for dx, dy in MOVES:
+                if dist.get((x + dx, y + dy)) == d + 1:
+                    pending.setdefault(d + 1, []).append((x + dx, y + dy))
+        d += 1
+
+    # Refill from the intact cells next to the changes and the cleared cells
+    touched = set(cleared)
+    if cleared:
+        dist = dict(dist)
+        for cell in cleared:
+            del dist[cell]
+    queue = {}
+    for x, y in around | cleared:
+        if not admits(x, y):
+            continue
+        best = best_from(x, y, dist)
+        if best <= level and best < dist.get((x, y), INF):
+            queue.setdefault(best, []).append((x, y))
+    if queue and not cleared:
+        dist = dict(dist)
+    for d, entries in queue.items():
+        for cell in entries:
+            dist[cell] = d
+            touched.add(cell)
+    d = min(queue, default=0)
+    while queue:
+        for x, y in queue.pop(d, ()):
+            if dist.get((x, y)) != d or d + 1 > level or (rows[x][y] != FREE and (x, y) not in sources):
+                continue
+            for dx, dy in MOVES:
+                nx, ny = x + dx, y + dy
+                if d + 1 < dist.get((nx, ny), INF) and admits(nx, ny) and steps(x, y, nx, ny):
+                    dist[(nx, ny)] = d + 1
+                    touched.add((nx, ny))
+                    queue.setdefault(d + 1, []).append((nx, ny))
+        d += 1
+
+    # Search on past level while a target is out of reach
+    remaining = _unreached(dist, layout, targets)
+    if remaining and level != INF:
+        if not touched:
+            dist = dict(dist)
+        frontier = [cell for cell, d in dist.items() if d == level and (cell in sources or rows[cell[0]][cell[1]] == FREE)]
+        d = level
+        while frontier and remaining:
+            d += 1
+            next_frontier = []
+            for x, y in frontier:
+                for dx, dy in MOVES:
+                    nx, ny = x + dx, y + dy
+                    if (nx, ny) in dist or not admits(nx, ny) or not steps(x, y, nx, ny):
+                        continue
+                    dist[(nx, ny)] = d
+                    touched.add((nx, ny))
+                    if rows[nx][ny] == FREE:
+                        next_frontier.append((nx, ny))
+                    else:
+                        remaining.discard(rows[nx][ny])
+            frontier = next_frontier
+        level = d if not remaining else INF
+    return dist, level, touched
+
+class RouteState:
+    """The distance fields of operation_routes, kept with an evaluated layout.
+
+    A child built from its parent's state repairs each field against the
+    cells that differ between the two grids (repair_field) rather than
+    searching again, and re-traces only the routes running through or beside
+    a cell whose distance or occupancy changed; fields whose root moved are
+    searched afresh. The routes are the ones operation_routes gives.
+    """
+    def __init__(self, grid, wide, operations, footprints):
+        self.grid = grid
+        self.wide = wide
+        self.operations = operations
+        self.footprints = footprints
+        self.roots = None
+        self.targets = None
+        self.fields = {}      # root id -> (distance field, level it is complete up to)
+        self.paths = None
+        self.retraced = None  # Operations re-traced from the parent's routes, None if all were traced
+        self._cells = None
+
+    @classmethod
+    def build(cls, layout, parent=None):
+        aisle_width = layout.aisle_width
+        state = cls(
+            layout.grid.copy(),
+            layout.wide_mask(aisle_width) if aisle_width > 1 else None,
+            tuple((int(op['from_entity']['id']), int(op['to_entity']['id'])) for op in layout.operations),
+            [tuple((p[0], p[1]) for p in entity['positions']) for entity in layout.entities],
+        )
+        if any(not state.footprints[i] for i in chain.from_iterable(state.operations)):
+            return state
+        state.roots, state.targets = operation_roots(state.operations)
+        if (parent is None or not parent.fields or parent.grid.shape != state.grid.shape
+                or parent.operations != state.operations or len(parent.footprints) != len(state.footprints)
+                or (parent.wide is None) != (state.wide is None)):
+            for root, targets in state.targets.items():
+                state.fields[root] = state._field(layout, root)
+            state._trace_all(layout, range(len(state.operations)))
+            return state
+
+        differs = parent.grid != state.grid
+        if state.wide is not None:
+            differs |= parent.wide != state.wide
+        xs, ys = np.nonzero(differs)
+        if not len(xs):
+            state.fields, state.paths, state._cells = parent.fields, parent.paths, parent._cells
+            state.retraced = []
+            return state
+        changed = list(zip(xs.tolist(), ys.tolist()))
+        moved = {i for i, (old, new) in enumerate(zip(parent.footprints, state.footprints)) if old != new}
+
+        # A route can only change where the grid or its field changed on or beside it
+        cells, route_of_cell = parent.route_cells() if parent.paths is not None else (None, None)
+
+        def near(mask):
+            mask = _dilate(mask)
+            if cells is None:
+                return mask, None
+            return mask, np.bincount(route_of_cell[mask[cells[:, 0], cells[:, 1]]], minlength=len(state.operations)) > 0
+
+        near_changes = near(differs)
+        nearby = {}
+        searched = set(moved)
+        for root, targets in state.targets.items():
+            if root in moved:
+                state.fields[root] = state._field(layout, root)
+                continue
+            dist, level = parent.fields[root]
+            dist, level, touched = repair_field(dist, level, state.footprints[root], layout, aisle_width,
+                                                targets, changed)
+            state.fields[root] = (dist, level)
+            if touched is None:
+                searched.add(root)
+            elif touched:
+                mask = differs.copy()
+                mask[tuple(np.array(list(touched)).T)] = True
+                nearby[root] = near(mask)
+        if parent.paths is None:
+            state._trace_all(layout, range(len(state.operations)))
+            return state
+
+        affected = []
+        for i, ((from_id, to_id), root) in enumerate(zip(state.operations, state.roots)):
+            mask, hit = nearby.get(root, near_changes)
+            if (from_id in moved or to_id in moved or root in searched or hit[i]
+                    or any(mask[c] for c in state.footprints[from_id + to_id - root])):
+                affected.append(i)
+        state.paths = list(parent.paths)
+        state._trace_all(layout, affected)
+        return state
+
+    def _field(self, layout, root):
+        targets = self.targets[root]
+        dist = distance_field(layout.entities[root]['positions'], layout, layout.aisle_width, targets)
+        return dist, field_level(dist, layout, targets)
+
+    def _trace_all(self, layout, indices):
+        # Trace the routes of the given operations down their roots' fields, from from_entity to to_entity
+        paths = self.paths if self.paths is not None else [None] * len(self.operations)
+        self.retraced = list(indices) if self.paths is not None else None
+        for i in indices:
+            from_id, to_id = self.operations[i]
+            root = self.roots[i]
+            dist = self.fields[root][0]
+            goal = closest_cell(dist, self.footprints[from_id + to_id - root])
+            path = trace_route(dist, goal, layout, layout.aisle_width) if goal is not None else None
+            if path is None:
+                self.paths = None
+                return
+            if root == from_id:
+                path.reverse()
+            paths[i] = path
+        self.paths = paths
+
+    def route_cells(self):
+        """Cells of every route stacked as an (n, 2) array, and the route each one belongs to."""
+        if self._cells is None:
+            lengths = [len(path) for path in self.paths]
+            cells = np.array(list(chain.from_iterable(self.paths)), dtype=np.int64).reshape(-1, 2)
+            self._cells = (cells, np.repeat(np.arange(len(lengths)), lengths))
+        return self._cells
+
+    def routes(self):
+        """Route for every operation, or None if any operation has no route."""
+        return list(self.paths) if self.paths is not None else None
+
+def _unreached(dist, layout, targets):
+    # Targets with no cell at a positive distance
+    return {target for target in targets
+            if not any(dist.get((p[0], p[1])) for p in layout.entities[target]['positions'])}
+
+def _dilate(mask):
+    # Cells on or one 4-connected step from a True cell
+    out = mask.copy()
+    out[1:, :] |= mask[:-1, :]
+    out[:-1, :] |= mask[1:, :]
+    out[:, 1:] |= mask[:, :-1]
+    out[:, :-1] |= mask[:, 1:]
+    return out
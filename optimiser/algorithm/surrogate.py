@@ -0,0 +1,98 @@
+import numpy as np
+from collections import deque
+from ..function.standard_layout_fitness import box_route_bounds, centroid_clustering, centroid_utility_access
+
+class Surrogate:
+    """Ridge regression from cheap layout features to fitness, trained online.
+
+    The GA adds every individual it scores with the real fitness function
+    and asks the model to rank candidate children before scoring them. Only
+    the latest max_samples pairs are kept, as the population drifts; the
+    model is refitted lazily when new samples have arrived.
+    """
+    def __init__(self, alpha=1.0, min_samples=20, max_samples=500):
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self._features = deque(maxlen=max_samples)
+        self._fitness = deque(maxlen=max_samples)
+        self._weights = None
+        self._stale = True
+
+    @property
+    def ready(self):
+        return len(self._fitness) >= self.min_samples
+
+    def add(self, features, fitness):
+        self._features.append(np.asarray(features, dtype=float))
+        self._fitness.append(float(fitness))
+        self._stale = True
+
+    def fit(self):
+        X = np.array(self._features)
+        y = np.array(self._fitness)
+        self._mean = X.mean(axis=0)
+        self._scale = X.std(axis=0)
+        self._scale[self._scale == 0] = 1
+        X = (X - self._mean) / self._scale
+        self._offset = y.mean()
+        # Closed-form ridge solution on standardised features
+        self._weights = np.linalg.solve(X.T @ X + self.alpha * np.eye(X.shape[1]), X.T @ (y - self._offset))
+        self._stale = False
+
+    def predict(self, features):
+        """Predicted fitness for each row of features."""
+        if self._stale:
+            self.fit()
+        X = (np.atleast_2d(np.asarray(features, dtype=float)) - self._mean) / self._scale
+        return X @ self._weights + self._offset
+
+def entity_boxes(layout):
+    """Bounding box (x0, y0, x1, y1) of every entity's footprint, NaN where it is not placed."""
+    boxes = np.full((len(layout.entities), 4), np.nan)
+    for index, entity in enumerate(layout.entities):
+        if entity['positions']:
+            cells = np.array([(p[0], p[1]) for p in entity['positions']])
+            boxes[index] = (*cells.min(axis=0), *cells.max(axis=0))
+    return boxes
+
+def genome_boxes(genome, base_boxes):
+    """entity_boxes of the layout a genome decodes to, read from its genes.
+
+    base_boxes is entity_boxes(genome.base), for the manually placed
+    entities. Genes that decode would have to repair are taken as they are.
+    """
+    boxes = base_boxes.copy()
+    auto = genome.base.auto_placed_entities
+    ids = [entity['id'] for entity in auto]
+    x, y = np.divmod(genome.anchors.astype(np.int64), genome.base.grid.shape[1])
+    width = np.array([entity['width'] for entity in auto])
+    length = np.array([entity['length'] for entity in auto])
+    swap = genome.orientation.astype(bool)
+    width, length = np.where(swap, length, width), np.where(swap, width, length)
+    boxes[ids] = np.stack([x, y, x + width - 1, y + length - 1], axis=1)
+    return boxes
+
+def layout_features(layout, boxes, context=None):
+    """Features of a placement that need no path search.
+
+    layout supplies the entities, operations and utilities; the footprints
+    come from boxes, so they can be read from a genome without decoding it.
+    """
+    ends = np.array([(int(op['from_entity']['id']), int(op['to_entity']['id'])) for op in layout.operations],
+                    dtype=np.int64).reshape(-1, 2)
+    lengths = box_route_bounds(boxes[ends[:, 0]], boxes[ends[:, 1]])
+    lengths = lengths[~np.isnan(lengths)]
+    if not len(lengths):
+        lengths = np.zeros(1)
+    centroids = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)[None]
+
+    # Scale distances by the floor size so the features mean the same on any layout
+    size = layout.width + layout.length
+    return [
+        lengths.mean() / size,
+        lengths.max() / size,
+        lengths.mean() / max(lengths.max(), 1),
+        np.median(lengths) / size,
+        centroid_clustering(layout.entities, centroids)[0],
+        centroid_utility_access([layout], centroids, context)[0],
+    ]
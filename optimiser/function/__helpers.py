@@ -1,5 +1,8 @@
-from queue import PriorityQueue
-import math
+import heapq
+import hashlib
+import numpy as np
+from ..algorithm.path_cache import path_cache, MISSING
+from models import FREE, vehicle_cells
 
 def normalise(self, value, min_val, max_val):
         if max_val == min_val:
@@ -10,81 +13,256 @@ def normalise(self, value, min_val, max_val):
 def manhattan_distance(p1, p2):
     return abs(p1[0] - p2[0]) + abs(p1[1] - p2[1])
 
-def astar(start, goal, layout, aisle_width = 1):
-    rows = layout.width
-    cols = layout.length
+def _layout_key(layout):
+    key = getattr(layout, 'grid_key', None)
+    if key is None:
+        # Equal bytes can be different grids, so the shape and dtype are part of the key
+        grid = np.asarray(layout)
+        key = (grid.shape, grid.dtype.str, hashlib.blake2b(grid.tobytes(), digest_size=16).digest())
+    return key
 
-    MOVES = [
-        (1, 0), (-1, 0), (0, 1), (0, -1),  # Up, Down, Left, Right
-        (1, 1), (1, -1), (-1, 1), (-1, -1)  # Diagonals
-    ]
+MOVES = [
+    (1, 0), (-1, 0), (0, 1), (0, -1),  # Up, Down, Left, Right
+    (1, 1), (1, -1), (-1, 1), (-1, -1)  # Diagonals
+]
 
-    def heuristic(a, b):
-        (x1, y1) = a
-        (x2, y2) = b
-        return math.hypot(x2 - x1, y2 - y1)
+def astar(start, goal, layout, aisle_width = 1, jps=None):
+    """8-connected shortest path, every move (diagonals included) costs 1.
 
+    Uses Jump Point Search on uniform grids (aisle_width <= 1) and plain A*
+    with the aisle width rules otherwise; jps forces either choice.
+    Both return paths of the same cost.
+
+    With aisle_width > 1 a cell may only be entered if vehicle_cells says
+    the vehicle fits there, or if it lies next to the start or the goal.
+    """
+    start = tuple(start)
+    goal = tuple(goal)
+    if jps is None:
+        jps = aisle_width <= 1
+    key = ('astar8', _layout_key(layout), start, goal, aisle_width, jps)
+    cached = path_cache.get(key)
+    if cached is not MISSING:
+        return list(cached) if cached is not None else None
+
+    is_open = _open_cells(layout, start, goal)
+    if jps:
+        path = _jump_point_search(start, goal, is_open)
+    else:
+        path = _astar(start, goal, is_open, _wide_cells(layout, aisle_width))
+    path_cache.put(key, tuple(path) if path is not None else None)
+    return path
+
+def _open_cells(layout, start, goal):
+    """Predicate telling whether an agent may stand on (x, y).
+
+    Accepts a Layout (1-based interior, walls and other entities blocked) or
+    a plain 2D array where 0 marks a blocked cell.
+    """
+    if hasattr(layout, 'grid_rows'):
+        rows = layout.grid_rows
+        width, length = layout.width, layout.length
+        endpoints = {rows[c[0]][c[1]] for c in (start, goal)
+                     if 1 <= c[0] <= width and 1 <= c[1] <= length} - {FREE}
+
+        def is_open(x, y):
+            if not (1 <= x <= width and 1 <= y <= length):
+                return False
+            value = rows[x][y]
+            return value == FREE or (value >= 0 and value in endpoints)
+    else:
+        rows = layout
+        width, length = len(layout), len(layout[0])
+
+        def is_open(x, y):
+            return 0 <= x < width and 0 <= y < length and rows[x][y] != 0
+
+    return is_open
+
+def _wide_cells(layout, aisle_width):
+    """Nested lists, True where a vehicle of aisle_width fits; None for 1-wide aisles."""
+    if aisle_width <= 1:
+        return None
+    if hasattr(layout, 'wide_rows'):
+        return layout.wide_rows(aisle_width)
+    # Plain arrays: obstacles are 0 and everything outside the array is blocked
+    return vehicle_cells(np.asarray(layout) != 0, aisle_width).tolist()
+
+def _heuristic(a, b):
+    # Moves cost 1 in all eight directions, so Chebyshev distance is exact on an empty grid
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+def _reconstruct(came_from, goal):
+    path = []
+    current = goal
+    while current:
+        path.append(current)
+        current = came_from[current]
+    path.reverse()
+    return path or None
+
+def _astar(start, goal, is_open, wide=None):
     def has_clearance(current, neighbor):
         (x1, y1) = current
         (x2, y2) = neighbor
-        dx = x2 - x1
-        dy = y2 - y1
 
-        # Bounds check
-        if not (0 <= x2 < rows and 0 <= y2 < cols):
-            return False
-        if layout[x2][y2] == 0:
+        if not is_open(x2, y2):
             return False
 
-        # Straight moves
-        if dx == 0 or dy == 0:
-            for i in range(-aisle_width // 2 + 1, aisle_width // 2 + 1):
-                check_x = x2 + (i if dx == 0 else 0)
-                check_y = y2 + (i if dy == 0 else 0)
-                if not (0 <= check_x < rows and 0 <= check_y < cols) or layout[check_x][check_y] == 0:
-                    return False
+        # One lookup in the wide cells, apart from the cells around the endpoints
+        if (wide is not None and not wide[x2][y2]
+                and _heuristic(neighbor, start) > 1 and _heuristic(neighbor, goal) > 1):
+            return False
 
         # Diagonal moves
-        if dx != 0 and dy != 0:
-            if layout[x1][y2] == 0 or layout[x2][y1] == 0:
+        if x1 != x2 and y1 != y2:
+            if not is_open(x1, y2) or not is_open(x2, y1):
                 return False
 
         return True
 
-    frontier = PriorityQueue()
-    frontier.put((0, start))
+    frontier = [(0, start)]
     came_from = {start: None}
     cost_so_far = {start: 0}
+    closed = set()
 
-    while not frontier.empty():
-        _, current = frontier.get()
-
+    while frontier:
+        _, current = heapq.heappop(frontier)
+        if current in closed:
+            continue
         if current == goal:
             break
+        closed.add(current)
 
         for move in MOVES:
             neighbor = (current[0] + move[0], current[1] + move[1])
 
-            if has_clearance(current, neighbor):
+            if neighbor not in closed and has_clearance(current, neighbor):
                 new_cost = cost_so_far[current] + 1  # cost of 1 per move
                 if neighbor not in cost_so_far or new_cost < cost_so_far[neighbor]:
                     cost_so_far[neighbor] = new_cost
-                    priority = new_cost + heuristic(neighbor, goal)
-                    frontier.put((priority, neighbor))
+                    priority = new_cost + _heuristic(neighbor, goal)
+                    heapq.heappush(frontier, (priority, neighbor))
                     came_from[neighbor] = current
 
     # Reconstruct path
     if goal not in came_from:
         return None
+    return _reconstruct(came_from, goal)
 
-    path = []
-    current = goal
-    while current:
-        path.append(current)
-        current = came_from[current]
-    path.reverse()
-    
-    if path == []:
+def _jump_point_search(start, goal, is_open):
+    """Jump Point Search without corner cutting, matching _astar's move rules."""
+    def jump(x, y, dx, dy):
+        # Walk from (x, y) in direction (dx, dy) until a jump point, a dead end or the goal
+        while True:
+            if not is_open(x, y):
+                return None
+            if (x, y) == goal:
+                return (x, y)
+            if dx and dy:
+                if jump(x + dx, y, dx, 0) or jump(x, y + dy, 0, dy):
+                    return (x, y)
+                # Diagonal steps need both orthogonal cells open
+                if not (is_open(x + dx, y) and is_open(x, y + dy)):
+                    return None
+            elif dx:
+                if ((is_open(x, y + 1) and not is_open(x - dx, y + 1)) or
+                        (is_open(x, y - 1) and not is_open(x - dx, y - 1))):
+                    return (x, y)
+            else:
+                if ((is_open(x + 1, y) and not is_open(x + 1, y - dy)) or
+                        (is_open(x - 1, y) and not is_open(x - 1, y - dy))):
+                    return (x, y)
+            x += dx
+            y += dy
+
+    def neighbors(node, parent):
+        x, y = node
+        if parent is None:
+            result = []
+            for dx, dy in MOVES:
+                if dx and dy:
+                    if is_open(x + dx, y) and is_open(x, y + dy) and is_open(x + dx, y + dy):
+                        result.append((dx, dy))
+                elif is_open(x + dx, y + dy):
+                    result.append((dx, dy))
+            return result
+
+        dx = (x > parent[0]) - (x < parent[0])
+        dy = (y > parent[1]) - (y < parent[1])
+        result = []
+        if dx and dy:
+            if is_open(x, y + dy):
+                result.append((0, dy))
+            if is_open(x + dx, y):
+                result.append((dx, 0))
+            if is_open(x, y + dy) and is_open(x + dx, y):
+                result.append((dx, dy))
+        elif dx:
+            next_open = is_open(x + dx, y)
+            up_open = is_open(x, y + 1)
+            down_open = is_open(x, y - 1)
+            if next_open:
+                result.append((dx, 0))
+                if up_open:
+                    result.append((dx, 1))
+                if down_open:
+                    result.append((dx, -1))
+            if up_open:
+                result.append((0, 1))
+            if down_open:
+                result.append((0, -1))
+        else:
+            next_open = is_open(x, y + dy)
+            right_open = is_open(x + 1, y)
+            left_open = is_open(x - 1, y)
+            if next_open:
+                result.append((0, dy))
+                if right_open:
+                    result.append((1, dy))
+                if left_open:
+                    result.append((-1, dy))
+            if right_open:
+                result.append((1, 0))
+            if left_open:
+                result.append((-1, 0))
+        return result
+
+    frontier = [(_heuristic(start, goal), 0, start)]
+    came_from = {start: None}
+    cost_so_far = {start: 0}
+    closed = set()
+
+    while frontier:
+        _, cost, current = heapq.heappop(frontier)
+        if current in closed:
+            continue
+        if current == goal:
+            break
+        closed.add(current)
+
+        for dx, dy in neighbors(current, came_from[current]):
+            point = jump(current[0] + dx, current[1] + dy, dx, dy)
+            if point is None or point in closed:
+                continue
+            new_cost = cost + _heuristic(current, point)
+            if new_cost < cost_so_far.get(point, float('inf')):
+                cost_so_far[point] = new_cost
+                came_from[point] = current
+                heapq.heappush(frontier, (new_cost + _heuristic(point, goal), new_cost, point))
+
+    if goal not in came_from:
         return None
-    else:
-        return path
+
+    # Expand the straight and diagonal segments between jump points
+    jump_points = _reconstruct(came_from, goal)
+    path = [jump_points[0]]
+    for point in jump_points[1:]:
+        x, y = path[-1]
+        dx = (point[0] > x) - (point[0] < x)
+        dy = (point[1] > y) - (point[1] < y)
+        while (x, y) != point:
+            x += dx
+            y += dy
+            path.append((x, y))
+    return path
@@ -1,57 +1,53 @@
 import math
-from ..algorithm.__helpers import astar, manhattan_distance
+from itertools import chain
+from ..algorithm.__helpers import manhattan_distance, operation_routes, population_operation_routes
+from ..algorithm.route_state import RouteState
 from typing import List, Dict, Any
 import numpy as np
 
-def get_fitness(layout, weights=None):
+def get_fitness(layout, weights=None, context=None, parent_state=None):
+    if context is None:
+        context = getattr(layout, 'context', None)
+    if parent_state is None:
+        parent_state = getattr(layout, 'parent_route_state', None)
     if weights is None:
         weights = [1, 1, 1, 1, 1]  # travel_distance, congestion_risk, turns, clustering, utility_access
 
-    # First try static metrics
-    routes = []
-    for operation in layout.operations:
-        temp_paths = []
-        from_coords = operation['from_entity']['positions']
-        to_coords = operation['to_entity']['positions']
-        for to_coord in to_coords:
-            for from_coord in from_coords:
-                path = astar(from_coord, to_coord, layout, layout.aisle_width)
-                if path:
-                    temp_paths.append(path)
-        if temp_paths != []:
-            routes.append(min(temp_paths, key=len))
-        else:
-            metrics = {
-                'travel_distance': 1.0,
-                'congestion_risk': 1.0,
-                'turns': 1.0,
-                'clustering': 0.0,
-                'utility_access': 0.0,
-                'total_fitness': -1.0
-            }
-            return -1, metrics  # Invalid layout if no path found
+    if getattr(layout, 'parent_fitness_state', None) is not None or getattr(layout, 'track_fitness', False):
+        # Rescore only the operations and entities that changed since the parent was evaluated
+        layout.fitness_state = FitnessState.build(layout, layout.parent_fitness_state, context)
+        layout.parent_fitness_state = None
+        return layout.fitness_state.evaluate(weights)
 
+    # First try static metrics
+    if parent_state is not None or getattr(layout, 'track_routes', False):
+        # Repair the parent's distance fields where the grids differ instead of starting cold
+        layout.route_state = RouteState.build(layout, parent_state)
+        layout.parent_route_state = None
+        routes = layout.route_state.routes()
+    else:
+        find_routes = getattr(layout, 'pathfinding', None) or operation_routes
+        routes = find_routes(layout, layout.aisle_width)
     if not routes:
-        metrics = {
-            'travel_distance': 1.0,
-            'congestion_risk': 1.0,
-            'turns': 1.0,
-            'clustering': 0.0,
-            'utility_access': 0.0,
-            'total_fitness': -1.0
-        }
-        return -1, metrics  # No valid routes found
+        return invalid_fitness()  # Invalid layout if no path found, or no routes at all
 
     # Calculate static metrics
     travel_distance = calc_avrg_distance(routes)
     congestion_risk = calc_congestion_risk(routes, layout.width, layout.length)
     nturns = calc_avrg_turns(routes)
-    clustering = calc_avrg_clustering_category(layout)
+    clustering = calc_avrg_clustering_category(layout, context)
 
     # Calculate utility access
-    utility_access = calc_utility_access(layout)
+    utility_access = calc_utility_access(layout, context)
+
+    # Return both total fitness and individual metrics
+    return weighted_fitness(weights, travel_distance, congestion_risk, nturns, clustering, utility_access)
+
+def weighted_fitness(weights, travel_distance, congestion_risk, nturns, clustering, utility_access, **flags):
+    """Combine the metrics with weights into (fitness, metrics) as get_fitness returns them.
 
-    # Combine metrics with weights
+    flags (such as estimated) are added to the metrics.
+    """
     fitness = (
         weights[0] * (1 - travel_distance) +
         weights[1] * (1 - congestion_risk) +
@@ -59,98 +55,413 @@ def get_fitness(layout, weights=None):
         weights[3] * clustering +
         weights[4] * utility_access
     )
-
-    # Return both total fitness and individual metrics
     metrics = {
         'travel_distance': travel_distance,
         'congestion_risk': congestion_risk,
         'turns': nturns,
         'clustering': clustering,
         'utility_access': utility_access,
-        'total_fitness': fitness
+        'total_fitness': fitness,
+        **flags
     }
-
     return fitness, metrics
 
+def invalid_fitness(**flags):
+    """(fitness, metrics) of a layout whose operations cannot all be routed."""
+    metrics = {
+        'travel_distance': 1.0,
+        'congestion_risk': 1.0,
+        'turns': 1.0,
+        'clustering': 0.0,
+        'utility_access': 0.0,
+        'total_fitness': -1.0,
+        **flags
+    }
+    return -1, metrics
+
+def get_population_fitness(layouts, weights=None, context=None):
+    """get_fitness for a whole population, returning the same (fitness, metrics) tuples.
+
+    Routes come from population_operation_routes, which grows the distance
+    fields of every layout as one 3D wavefront. Route metrics, clustering and
+    utility access are then computed on arrays stacked across the population,
+    summing in the same order as the per-layout functions. Layouts that route
+    through a parent's search or fitness state or another pathfinding
+    backend go through get_fitness one by one.
+    """
+    if weights is None:
+        weights = [1, 1, 1, 1, 1]  # travel_distance, congestion_risk, turns, clustering, utility_access
+    results = [None] * len(layouts)
+    batch = []
+    for i, layout in enumerate(layouts):
+        if (getattr(layout, 'parent_route_state', None) is not None or getattr(layout, 'track_routes', False)
+                or getattr(layout, 'parent_fitness_state', None) is not None or getattr(layout, 'track_fitness', False)
+                or getattr(layout, 'pathfinding', None) not in (None, operation_routes)):
+            results[i] = get_fitness(layout, weights, context)
+        else:
+            batch.append(i)
+    if not batch:
+        return results
+
+    routed = []
+    for i, routes in zip(batch, population_operation_routes([layouts[i] for i in batch])):
+        if not routes:
+            results[i] = invalid_fitness()
+        else:
+            routed.append((i, routes))
+    if not routed:
+        return results
+
+    members = [layouts[i] for i, _ in routed]
+    if context is None:
+        context = getattr(members[0], 'context', None)
+    travel_distance, congestion_risk, nturns = _population_route_metrics(members, [r for _, r in routed])
+    centroids = np.stack([_centroids(layout, context) for layout in members])
+    clustering = centroid_clustering(members[0].entities, centroids)
+    utility_access = centroid_utility_access(members, centroids, context)
+
+    for k, (i, _) in enumerate(routed):
+        results[i] = weighted_fitness(weights, float(travel_distance[k]), float(congestion_risk[k]), float(nturns[k]),
+                                      float(clustering[k]), float(utility_access[k]))
+    return results
+
+class FitnessState:
+    """Per-operation routes and per-entity scores kept with an evaluated layout.
+
+    Routes come from a RouteState, so a child built from its parent's state
+    repairs the parent's distance fields and re-traces only the routes the
+    changes reach. The usage, lengths and turns of those routes are swapped
+    into the parent's totals, and the clustering and utility terms of the
+    moved entities rescored. Every metric equals get_fitness on the same
+    layout, except that the clustering sum may differ from it in the last
+    bits.
+    """
+    def __init__(self, route_state, footprints, centroids):
+        self.route_state = route_state
+        self.footprints = footprints
+        self.centroids = centroids
+        self.routes = route_state.routes()
+
+    @classmethod
+    def build(cls, layout, parent=None, context=None, changed=None):
+        """State for layout, reusing parent's where it still holds.
+
+        changed is the set of indices of the entities that moved since
+        parent; by default it is found by comparing footprints.
+        """
+        state = cls(
+            RouteState.build(layout, parent.route_state if parent is not None else None),
+            [tuple((p[0], p[1]) for p in entity['positions']) for entity in layout.entities],
+            _centroids(layout, context),
+        )
+        if state.routes is None:
+            return state
+        if (parent is None or parent.routes is None or state.route_state.retraced is None
+                or len(parent.footprints) != len(state.footprints)):
+            state._score_all(layout, context)
+            return state
+
+        if changed is None:
+            changed = {i for i, (old, new) in enumerate(zip(parent.footprints, state.footprints)) if old != new}
+        state._reroute(parent)
+        state._rescore(layout, parent, sorted(changed), context)
+        return state
+
+    def _score_all(self, layout, context):
+        cells, route_of_cell = self.route_state.route_cells()
+        self.lengths = np.array([len(route) for route in self.routes], dtype=np.int64)
+        self.turns = _route_turns(cells, route_of_cell, len(self.routes))
+        self.usage = np.bincount(cells[:, 0] * layout.grid.shape[1] + cells[:, 1], minlength=layout.grid.size)
+
+        self.categories = {}
+        for index, entity in enumerate(layout.entities):
+            self.categories.setdefault(entity['category'], []).append(index)
+        self.categories = {category: np.array(members) for category, members in self.categories.items()
+                           if len(members) > 1}
+        self.total_pairs = sum(len(members) * (len(members) - 1) // 2 for members in self.categories.values())
+        # Closeness of every entity to the others of its category; each pair counts twice
+        self.closeness = np.zeros(len(layout.entities))
+        for members in self.categories.values():
+            first, second = np.triu_indices(len(members), 1)
+            first, second = members[first], members[second]
+            score = 1 / (np.abs(self.centroids[first, 0] - self.centroids[second, 0])
+                         + np.abs(self.centroids[first, 1] - self.centroids[second, 1]) + 1)
+            self.closeness += np.bincount(first, weights=score, minlength=len(self.closeness))
+            self.closeness += np.bincount(second, weights=score, minlength=len(self.closeness))
+
+        self.dependent = _dependent_entities(layout.entities)
+        self.utility = np.zeros(len(self.dependent))
+        if self.dependent:
+            self.utility = _utility_scores(layout, self.dependent, self.centroids[None, self.dependent], context)[0]
+
+    def _reroute(self, parent):
+        # Swap the re-traced routes' cells, lengths and turns into the parent's totals
+        affected = self.route_state.retraced
+        self.lengths, self.turns, self.usage = parent.lengths, parent.turns, parent.usage
+        if not affected:
+            return
+        old_cells, _, _ = _route_cells([parent.routes[i] for i in affected])
+        new_cells, lengths, route_of_cell = _route_cells([self.routes[i] for i in affected])
+        stride = self.route_state.grid.shape[1]
+        size = self.route_state.grid.size
+        self.usage = (parent.usage
+                      + np.bincount(new_cells[:, 0] * stride + new_cells[:, 1], minlength=size)
+                      - np.bincount(old_cells[:, 0] * stride + old_cells[:, 1], minlength=size))
+        self.lengths = parent.lengths.copy()
+        self.lengths[affected] = lengths
+        self.turns = parent.turns.copy()
+        self.turns[affected] = _route_turns(new_cells, route_of_cell, len(affected))
+
+    def _rescore(self, layout, parent, changed, context):
+        self.categories = parent.categories
+        self.total_pairs = parent.total_pairs
+        self.dependent = parent.dependent
+        if not changed:
+            self.closeness = parent.closeness
+            self.utility = parent.utility
+            return
+
+        self.closeness = parent.closeness.copy()
+        for members in self.categories.values():
+            moved = members[np.isin(members, changed)]
+            if not len(moved):
+                continue
+            terms = []
+            for centroids in (self.centroids, parent.centroids):
+                score = 1 / (np.abs(centroids[members, None, 0] - centroids[None, moved, 0])
+                             + np.abs(centroids[members, None, 1] - centroids[None, moved, 1]) + 1)
+                score[members[:, None] == moved[None, :]] = 0
+                terms.append(score)
+            still = ~np.isin(members, moved)
+            self.closeness[members[still]] += terms[0][still].sum(axis=1) - terms[1][still].sum(axis=1)
+            self.closeness[moved] = terms[0].sum(axis=0)
+
+        self.utility = parent.utility
+        moved = set(changed)
+        columns = [column for column, index in enumerate(self.dependent) if index in moved]
+        if columns:
+            indices = [self.dependent[column] for column in columns]
+            self.utility = parent.utility.copy()
+            self.utility[columns] = _utility_scores(layout, indices, self.centroids[None, indices], context)[0]
+
+    def evaluate(self, weights=None):
+        """(fitness, metrics) as returned by get_fitness."""
+        if weights is None:
+            weights = [1, 1, 1, 1, 1]  # travel_distance, congestion_risk, turns, clustering, utility_access
+        if not self.routes:
+            return invalid_fitness()  # Invalid layout if no path found
+
+        longest = int(self.lengths.max())
+        travel_distance = int(self.lengths.sum()) / len(self.lengths) / longest if longest > 0 else 1.0
+        used = self.usage[self.usage > 0]
+        congestion_risk = int(used.sum()) / len(used) / int(used.max()) if len(used) else 1.0
+        turns = self.turns[self.lengths >= 3]
+        nturns = int(turns.sum()) / len(turns) / int(turns.max()) if len(turns) and turns.max() > 0 else 1.0
+        clustering = float(self.closeness.sum()) / 2 / self.total_pairs if self.total_pairs > 0 else 0
+        utility_access = float(np.cumsum(self.utility)[-1]) / len(self.dependent) if self.dependent else 0.0
+        return weighted_fitness(weights, travel_distance, congestion_risk, nturns, clustering, utility_access)
+
+def _population_route_metrics(layouts, routes):
+    """calc_avrg_distance, calc_congestion_risk and calc_avrg_turns for many route sets."""
+    owner = np.repeat(np.arange(len(routes)), [len(r) for r in routes])
+    cells, lengths, route_of_cell = _route_cells([route for layout_routes in routes for route in layout_routes])
+
+    n = len(routes)
+    sums = np.bincount(owner, weights=lengths, minlength=n)
+    counts = np.bincount(owner, minlength=n)
+    longest = np.zeros(n)
+    np.maximum.at(longest, owner, lengths)
+    travel_distance = np.where(longest > 0, sums / counts / np.where(longest > 0, longest, 1), 1.0)
+
+    # Usage of every cell, per layout
+    usage = np.zeros((n,) + layouts[0].grid.shape, dtype=np.int64)
+    np.add.at(usage, (owner[route_of_cell], cells[:, 0], cells[:, 1]), 1)
+    used = usage.reshape(n, -1)
+    busiest = used.max(axis=1)
+    congestion_risk = np.where(busiest > 0, used.sum(axis=1) / np.maximum((used > 0).sum(axis=1), 1)
+                               / np.maximum(busiest, 1), 0.0)
+
+    turns = _route_turns(cells, route_of_cell, len(lengths))
+    counted = lengths >= 3
+    turn_owner = owner[counted]
+    turn_counts = np.bincount(turn_owner, minlength=n)
+    turn_sums = np.bincount(turn_owner, weights=turns[counted], minlength=n)
+    most_turns = np.zeros(n)
+    np.maximum.at(most_turns, turn_owner, turns[counted])
+    nturns = np.where((turn_counts > 0) & (most_turns > 0),
+                      turn_sums / np.maximum(turn_counts, 1) / np.maximum(most_turns, 1), 1.0)
+    return travel_distance, congestion_risk, nturns
+
+def centroid_clustering(entities, centroids):
+    """calc_avrg_clustering_category for a stack of centroids (layouts x entities x 2)."""
+    categories = {}
+    for index, entity in enumerate(entities):
+        categories.setdefault(entity['category'], []).append(index)
+
+    total = np.zeros(len(centroids))
+    total_pairs = 0
+    for members in categories.values():
+        if len(members) < 2:
+            continue
+        first, second = np.triu_indices(len(members), 1)
+        first, second = np.array(members)[first], np.array(members)[second]
+        dist = (np.abs(centroids[:, first, 0] - centroids[:, second, 0])
+                + np.abs(centroids[:, first, 1] - centroids[:, second, 1]))
+        # cumsum adds left to right, continuing the running total of the loop version
+        total = np.cumsum(np.concatenate([total[:, None], 1 / (dist + 1)], axis=1), axis=1)[:, -1]
+        total_pairs += len(first)
+    return total / total_pairs if total_pairs > 0 else np.zeros(len(centroids))
+
+def centroid_utility_access(layouts, centroids, context=None):
+    """calc_utility_access for a stack of centroids (layouts x entities x 2)."""
+    dependent = _dependent_entities(layouts[0].entities)
+    if not dependent:
+        return np.zeros(len(layouts))
+    per_entity = _utility_scores(layouts[0], dependent, centroids[:, dependent], context)
+    return np.cumsum(per_entity, axis=1)[:, -1] / len(dependent)
+
+def _dependent_entities(entities):
+    # Indices of the entities that count towards utility access
+    return [index for index, entity in enumerate(entities)
+            if entity.get('depends_on') and entity['depends_on'] != ['none']]
+
+def _utility_scores(layout, indices, centroids, context=None):
+    # Utility score of each of the given entities (layouts x entities), from their centroids
+    depends_on = [layout.entities[index]['depends_on'] for index in indices]
+    x = centroids[..., 0]
+    y = centroids[..., 1]
+
+    # Add each entity's utility types in its own order, one position of the list at a time
+    score = np.zeros(x.shape)
+    for k in range(max(len(types) for types in depends_on)):
+        by_type = {}
+        for column, types in enumerate(depends_on):
+            if k < len(types):
+                by_type.setdefault(types[k], []).append(column)
+        for utility_type, columns in by_type.items():
+            nearest = _nearest_utility(layout, utility_type, x[:, columns], y[:, columns], context)
+            if nearest is not None:
+                score[:, columns] += 1 / (nearest + 1)
+
+    placed = ~np.isnan(x)
+    counts = np.array([len(types) for types in depends_on])
+    return np.where(placed & (score > 0), score / counts, 0.0)
+
+def _nearest_utility(layout, utility_type, x, y, context=None):
+    # Manhattan distance from every (x, y) to the nearest utility of a type, None if there are none
+    if context is not None:
+        points = context.utility_points.get(utility_type)
+    else:
+        points = np.array([(p[0], p[1]) for p in layout.utilities.get(utility_type, [])]).reshape(-1, 2)
+    if points is None or len(points) == 0:
+        return None
+    nearest = np.full(x.shape, np.nan)
+    on_cell = np.isfinite(x) & np.isfinite(y)
+    if context is not None:
+        # Whole-cell centroids read the precomputed distance field
+        on_cell &= (x == np.floor(x)) & (y == np.floor(y))
+        xs, ys = np.where(on_cell, x, 0).astype(np.int64), np.where(on_cell, y, 0).astype(np.int64)
+        on_cell &= (xs >= 0) & (xs < context.shape[0]) & (ys >= 0) & (ys < context.shape[1])
+        nearest[on_cell] = context.utility_distance[utility_type][xs[on_cell], ys[on_cell]]
+    else:
+        on_cell[:] = False
+    rest = np.isfinite(x) & np.isfinite(y) & ~on_cell
+    if rest.any():
+        nearest[rest] = np.min(np.abs(x[rest][:, None] - points[None, :, 0])
+                               + np.abs(y[rest][:, None] - points[None, :, 1]), axis=1)
+    return nearest
+
+def _route_cells(routes):
+    # Every route's cells as one (cells x 2) array, with the length of each route
+    # and the index of the route each cell belongs to
+    lengths = np.array([len(route) for route in routes], dtype=np.int64)
+    cells = np.fromiter(chain.from_iterable(chain.from_iterable(routes)), dtype=np.int64).reshape(-1, 2)
+    route_of_cell = np.repeat(np.arange(len(lengths)), lengths)
+    return cells, lengths, route_of_cell
+
+def _route_turns(cells, route_of_cell, n_routes):
+    # A turn is a move that differs from the one before it in the same route
+    moves = np.diff(cells, axis=0)
+    same_route = route_of_cell[1:] == route_of_cell[:-1]
+    turn = (moves[1:] != moves[:-1]).any(axis=1) & same_route[1:] & same_route[:-1]
+    return np.bincount(route_of_cell[2:][turn], minlength=n_routes)
+
+def route_length_bounds(layout):
+    """Fewest cells any route of each operation can have, or None if an endpoint is not placed.
+
+    Footprints are rectangles, so the Manhattan gap between their bounding
+    boxes is the shortest distance between any two of their cells.
+    """
+    boxes = operation_boxes(layout)
+    if boxes is None:
+        return None
+    return box_route_bounds(*boxes)
+
+def operation_boxes(layout):
+    """Bounding boxes (x0, y0, x1, y1) of the from and to footprints of every operation.
+
+    Returns two (operations x 4) arrays, or None if an endpoint is not placed.
+    """
+    boxes = {}
+    for op in layout.operations:
+        for end in (op['from_entity'], op['to_entity']):
+            if not end['positions']:
+                return None
+            if end['id'] not in boxes:
+                xs = [p[0] for p in end['positions']]
+                ys = [p[1] for p in end['positions']]
+                boxes[end['id']] = (min(xs), min(ys), max(xs), max(ys))
+    ends = np.array([(boxes[op['from_entity']['id']], boxes[op['to_entity']['id']]) for op in layout.operations],
+                    dtype=np.int64).reshape(-1, 2, 4)
+    return ends[:, 0], ends[:, 1]
+
+def box_route_bounds(a, b):
+    """Fewest cells of a route between footprints with bounding boxes a and b (rows of x0, y0, x1, y1)."""
+    gap_x = np.maximum(0, np.maximum(a[:, 0] - b[:, 2], b[:, 0] - a[:, 2]))
+    gap_y = np.maximum(0, np.maximum(a[:, 1] - b[:, 3], b[:, 1] - a[:, 3]))
+    return gap_x + gap_y + 1
+
 def calc_congestion_risk(routes, width, length):
     if not routes:
         return 1.0  # Maximum congestion if no routes
-        
-    # Create a grid to track path usage
-    grid = [[0 for _ in range(width)] for _ in range(length)]
-    count = 0
-    for route in routes:
-        for x, y in route:
-            # Convert 1-based coordinates to 0-based
-            grid_x = x - 1
-            grid_y = y - 1
-            if 0 <= grid_x < width and 0 <= grid_y < length:
-                grid[grid_x][grid_y] += 1
-                count += 1
-    
-    if count == 0:
+
+    # Count how often every cell is used, converting 1-based coordinates to 0-based
+    cells, _, _ = _route_cells(routes)
+    cells = cells - 1
+    inside = (cells[:, 0] >= 0) & (cells[:, 0] < width) & (cells[:, 1] >= 0) & (cells[:, 1] < length)
+    if not inside.any():
         return 1.0
-        
-    congested_paths = []
-    for x in range(width):
-        for y in range(length):
-            if grid[x][y] != 0:
-                congested_paths.append(grid[x][y])
-
-    if not congested_paths:
-        return 0.0
-        
-    max_congestion = max(congested_paths)
-    min_congestion = min(congested_paths)
-    avrg_congestion = sum(congested_paths) / len(congested_paths)
-    
+    grid = np.bincount(cells[inside, 0] * length + cells[inside, 1], minlength=width * length)
+
+    congested_paths = grid[grid != 0]
+    max_congestion = int(congested_paths.max())
+    avrg_congestion = int(congested_paths.sum()) / len(congested_paths)
+
     # Normalize to 0-1 range
     return avrg_congestion / max_congestion if max_congestion > 0 else 0.0
 
 def calc_avrg_distance(routes):
     if not routes:
         return 1.0  # Maximum distance if no routes
-        
-    distances = []
-    for route in routes: 
-        distances.append(len(route))
 
-    if not distances:
-        return 1.0
-        
-    max_distance = max(distances)
-    min_distance = min(distances)
-    avrg_distance = sum(distances)/len(routes)
-    
+    distances = np.array([len(route) for route in routes])
+    max_distance = int(distances.max())
+    avrg_distance = int(distances.sum()) / len(routes)
+
     # Normalize to 0-1 range
     return avrg_distance / max_distance if max_distance > 0 else 1.0
 
 def calc_avrg_turns(routes):
     if not routes:
         return 1.0  # Maximum turns if no routes
-        
-    turns_list = []
-    for path in routes:
-        turns = 0
-        if not path or len(path) < 3:
-            continue  # No turns if path is too short
 
-        prev_move = (path[1][0] - path[0][0], path[1][1] - path[0][1])
-
-        for i in range(2, len(path)):
-            move = (path[i][0] - path[i-1][0], path[i][1] - path[i-1][1])
-            if move != prev_move:
-                turns += 1
-            prev_move = move
-
-        turns_list.append(turns)
-
-    if not turns_list:
+    cells, lengths, route_of_cell = _route_cells(routes)
+    turns_list = _route_turns(cells, route_of_cell, len(lengths))[lengths >= 3]  # No turns if path is too short
+    if not len(turns_list):
         return 1.0
-        
-    max_turns = max(turns_list)
-    min_turns = min(turns_list)
-    avrg_turns = sum(turns_list)/len(turns_list)
+
+    max_turns = int(turns_list.max())
+    avrg_turns = int(turns_list.sum()) / len(turns_list)
 
     # Normalize to 0-1 range
     return avrg_turns / max_turns if max_turns > 0 else 1.0
@@ -222,72 +533,30 @@ def calc_avrg_clustering_type(layout):
     clustering = clustering / total_pairs if total_pairs > 0 else 0
 
 
-def calc_avrg_clustering_category(layout):
-    # Calculate clustering score based on entity category
-    entity_types = {}
-    for entity in layout.entities:
-        etype = entity['category']
-        if etype not in entity_types:
-            entity_types[etype] = []
-        entity_types[etype].append(entity['positions'])
-    
-    # Calculate average distance between entities of same category
-    clustering = 0
-    total_pairs = 0
-    for positions in entity_types.values():
-        if len(positions) > 1:
-            for i in range(len(positions)):
-                xi_avg =  sum(x for x, y in positions[i]) / len(positions[i])
-                yi_avg = sum(y for x, y in positions[i]) / len(positions[i])
-                for j in range(i + 1, len(positions)):
-                    xj_avg =  sum(x for x, y in positions[j]) / len(positions[j])
-                    yj_avg = sum(y for x, y in positions[j]) / len(positions[j])
-                    dist = manhattan_distance((xi_avg, yi_avg), (xj_avg, yj_avg))
-                    clustering += 1 / (dist + 1)  # Closer entities = higher score
-                    total_pairs += 1
-    
-    clustering = clustering / total_pairs if total_pairs > 0 else 0
-    return clustering
+def _centroids(layout, context=None):
+    # Centroid of every entity as an (entities x 2) array, NaN for entities not placed
+    entities = layout.entities
+    sizes = np.array([len(entity['positions']) for entity in entities], dtype=np.int64)
+    cells = np.fromiter(chain.from_iterable((p[0], p[1]) for entity in entities for p in entity['positions']),
+                        dtype=np.int64).reshape(-1, 2)
+    owner = np.repeat(np.arange(len(entities)), sizes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroids = np.stack([np.bincount(owner, weights=cells[:, 0], minlength=len(entities)),
+                              np.bincount(owner, weights=cells[:, 1], minlength=len(entities))], axis=1) / sizes[:, None]
+    centroids[sizes == 0] = np.nan
+    if context is not None:
+        for index, entity in enumerate(entities):
+            if entity['id'] in context.manual_centroids:
+                centroids[index] = context.manual_centroids[entity['id']]
+    return centroids
 
-def calc_utility_access(layout):
-    total_utility_score = 0
-    entity_count = 0
+def calc_avrg_clustering_category(layout, context=None):
+    # Average closeness of every pair of entities in the same category (closer entities = higher score)
+    return float(centroid_clustering(layout.entities, _centroids(layout, context)[None])[0])
 
-    # For each entity that requires utilities
-    for entity in layout.entities:
-        if entity.get('depends_on') and entity['depends_on'] != ['none']:  # Skip entities with no dependencies
-            entity_count += 1
-            entity_score = 0
-            
-            # Get entity's position
-            positions = entity.get('positions')
-            if not positions:
-                continue
-            
-            if len(positions) == 1:
-                entity_pos = (positions[0][0], positions[0][1])
-            else:
-                entity_pos = ((sum([p[0] for p in positions])/len(positions))),(sum([p[1] for p in positions])/len(positions))
-
-            # For each utility type this entity depends on
-            for utility_type in entity['depends_on']:
-                # Find the nearest utility point of this type
-                min_dist = float('inf')
-                for utility_pos in layout.utilities.get(utility_type, []):
-                    dist = manhattan_distance(entity_pos, utility_pos)
-                    if dist < min_dist:
-                        min_dist = dist
-                
-                # Add inverse distance to score (closer = better)
-                if min_dist != float('inf'):
-                    entity_score += 1 / (min_dist + 1)  # +1 to avoid division by zero
-            
-            # Average the utility scores for this entity
-            if entity_score > 0:
-                total_utility_score += entity_score / len(entity['depends_on'])
-    
-    # Return average utility access score across all entities
-    return total_utility_score / entity_count if entity_count > 0 else 0.0
+def calc_utility_access(layout, context=None):
+    # Average over entities that require utilities of the inverse distance to the nearest one of each type
+    return float(centroid_utility_access([layout], _centroids(layout, context)[None], context)[0])
 
 def _diagonal_and_cross_score(self):
         # Aisle = all empty positions
@@ -0,0 +1,76 @@
+import numpy as np
+from . import standard_layout_fitness
+from .standard_layout_fitness import (calc_avrg_clustering_category, calc_utility_access, invalid_fitness,
+                                     route_length_bounds, weighted_fitness)
+
+# Individuals scored by each stage since the last reset_stats()
+counts = {'estimated': 0, 'full': 0, 'skipped': 0}
+
+def get_fitness(layout, weights=None, context=None):
+    # A single layout has nothing to be ranked against, so it always gets the full evaluation
+    counts['full'] += 1
+    return standard_layout_fitness.get_fitness(layout, weights, context)
+
+def get_population_fitness(layouts, weights=None, context=None, threshold=0.7):
+    """Score a population in two stages.
+
+    Every layout first gets estimate_fitness, which needs no path search.
+    Only those at or above the threshold percentile of the estimates get
+    the full standard_layout_fitness evaluation. The rest keep their
+    estimate, shifted below the lowest full score so that the ranking
+    never prefers them, and their metrics are marked 'estimated'.
+    """
+    estimates = [estimate_fitness(layout, weights, context) for layout in layouts]
+    counts['estimated'] += len(layouts)
+    results = list(estimates)
+
+    valid = [i for i, (fitness, _) in enumerate(estimates) if fitness != -1]
+    if not valid:
+        return results
+    cutoff = np.quantile([estimates[i][0] for i in valid], threshold)
+    full = [i for i in valid if estimates[i][0] >= cutoff]
+    skipped = [i for i in valid if estimates[i][0] < cutoff]
+    counts['full'] += len(full)
+    counts['skipped'] += len(skipped)
+
+    scored = standard_layout_fitness.get_population_fitness([layouts[i] for i in full], weights, context)
+    for i, result in zip(full, scored):
+        results[i] = result
+
+    floor = min((results[i][0] for i in full if results[i][0] != -1), default=None)
+    if floor is not None and skipped:
+        shift = max(0, max(estimates[i][0] for i in skipped) - floor)
+        for i in skipped:
+            fitness, metrics = estimates[i]
+            results[i] = fitness - shift, dict(metrics, total_fitness=fitness - shift)
+    return results
+
+def estimate_fitness(layout, weights=None, context=None):
+    """Cheap fitness estimate with the terms of get_fitness.
+
+    Route lengths are Manhattan lower bounds between the endpoint
+    footprints; congestion and turns cannot be known without routes and
+    count at their best. Clustering and utility access are exact.
+    """
+    if weights is None:
+        weights = [1, 1, 1, 1, 1]  # travel_distance, congestion_risk, turns, clustering, utility_access
+    lengths = route_length_bounds(layout)
+    if lengths is None or not len(lengths):
+        return invalid_fitness(estimated=True)
+
+    travel_distance = int(lengths.sum()) / len(lengths) / int(lengths.max())
+    congestion_risk = 0.0
+    nturns = 0.0
+    clustering = calc_avrg_clustering_category(layout, context)
+    utility_access = calc_utility_access(layout, context)
+    return weighted_fitness(weights, travel_distance, congestion_risk, nturns, clustering, utility_access,
+                            estimated=True)
+
+def stats():
+    """Stage counts since the last reset, with the share of full evaluations skipped."""
+    scored = counts['full'] + counts['skipped']
+    return dict(counts, skip_rate=counts['skipped'] / scored if scored else 0.0)
+
+def reset_stats():
+    for key in counts:
+        counts[key] = 0
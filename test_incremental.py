@@ -0,0 +1,79 @@
+from models import FREE, Layout, StaticContext
+from optimiser.algorithm.__helpers import operation_routes
+from optimiser.algorithm.route_state import RouteState
+from optimiser.function.standard_layout_fitness import FitnessState, get_fitness
+import math
+import random
+
+def warehouse_layout(seed):
+    """30 x 24 floor with a wall stub, racks and stations wired to a dock, randomly placed."""
+    random.seed(seed)
+    layout = Layout(30, 24)
+    structure = {f"15,{y}": 'wall' for y in range(4, 20)}
+    structure.update({'1,1': 'loading', '2,1': 'loading', '30,24': 'ex'})
+    layout.add_structure(structure)
+    layout.add_zones({f"{x},{y}": 'lowTemp' for x in range(1, 6) for y in range(1, 8)})
+    layout.add_utilities({'3,3': 'electric', '28,22': 'electric', '5,10': 'water'})
+    layout.add_entities([
+        {'category': 'storage', 'type': 'rack', 'placement': 'auto', 'quantity': 12, 'width': 1,
+         'length': 1 + 2 * (seed % 2), 'depends_on': ['electric'], 'within_zone': 'none'},
+        {'category': 'station', 'type': 'pack', 'placement': 'auto', 'quantity': 2, 'width': 2, 'length': 2,
+         'depends_on': ['electric', 'water'], 'within_zone': 'none'},
+        {'category': 'storage', 'type': 'cold', 'placement': 'auto', 'quantity': 1, 'width': 1, 'length': 1,
+         'depends_on': 'none', 'within_zone': 'lowTemp'},
+    ])
+    auto = layout.auto_placed_entities
+    operations = [{'from_entity': str(entity['id']), 'to_entity': '0', 'frequency': 1} for entity in auto]
+    operations += [{'from_entity': str(random.choice(auto)['id']), 'to_entity': str(random.choice(auto)['id']),
+                    'frequency': 2} for _ in range(4)]
+    layout.add_operations(operations)
+    layout.builder.randomise_layout()
+    return layout
+
+def moved(layout, count):
+    """Clone of layout with count random auto-placed entities re-placed, as a GA child would be."""
+    child = layout.clone()
+    for entity in random.sample(child.auto_placed_entities, count):
+        child._mark(entity['positions'], FREE)
+        entity['positions'] = []
+        available = child.builder.candidate_positions(entity)
+        if available:
+            child.builder.place_entity(entity, random.choice(available))
+    child.refresh_operations()
+    return child
+
+def test_repaired_routes_match_cold_search():
+    # Chains of children repair their parent's fields, so errors would compound down the chain
+    for seed in range(4):
+        for aisle_width in (1, 2, 3):
+            layout = warehouse_layout(seed)
+            layout.aisle_width = aisle_width
+            state = RouteState.build(layout)
+            assert state.routes() == operation_routes(layout, aisle_width)
+            for _ in range(15):
+                child = moved(layout, random.choice((1, 1, 2, 4)))
+                child_state = RouteState.build(child, state)
+                assert child_state.routes() == operation_routes(child, aisle_width)
+                if random.random() < 0.6:
+                    layout, state = child, child_state
+
+def test_fitness_state_matches_get_fitness():
+    for seed in range(4):
+        for aisle_width in (1, 2, 3):
+            layout = warehouse_layout(seed)
+            layout.aisle_width = aisle_width
+            context = StaticContext(layout) if seed % 2 else None
+            state = FitnessState.build(layout, None, context)
+            for _ in range(15):
+                child = moved(layout, random.choice((1, 1, 2, 4)))
+                child_state = FitnessState.build(child, state, context)
+                fitness, metrics = child_state.evaluate()
+                expected_fitness, expected = get_fitness(child, context=context)
+                # Only the clustering sum, and so the total, may differ in the last bits
+                assert math.isclose(fitness, expected_fitness, rel_tol=1e-12, abs_tol=1e-12)
+                for name in ('clustering', 'total_fitness'):
+                    if name in expected:
+                        assert math.isclose(metrics.pop(name), expected.pop(name), rel_tol=1e-12, abs_tol=1e-12)
+                assert metrics == expected
+                if random.random() < 0.6:
+                    layout, state = child, child_state
@@ -0,0 +1,46 @@
+from models import Layout, vehicle_cells
+from optimiser.algorithm import csgraph_routes
+from optimiser.algorithm.__helpers import operation_routes
+from optimiser.function.__helpers import astar
+import numpy as np
+
+def corridor_layout(corridor_width):
+    """12 x 8 floor walled off apart from a corridor along y = 4, with an entity at each end."""
+    layout = Layout(12, 8)
+    layout.add_structure({f"{x},{y}": 'wall' for x in range(1, 13) for y in range(1, 9)
+                          if not 4 <= y < 4 + corridor_width})
+    layout.add_entities([{'category': 'storage', 'type': 'rack', 'placement': 'manual', 'quantity': 2,
+                          'width': 1, 'length': 1, 'depends_on': ['none'], 'within_zone': 'none'}])
+    layout.add_positions({'1,4': 0, '12,4': 1})
+    layout.add_operations([{'from_entity': '0', 'to_entity': '1', 'frequency': 1}])
+    return layout
+
+def test_vehicle_cells():
+    free = np.ones((4, 4), dtype=bool)
+    # Odd widths are centred on the cell, even ones reach one cell further on
+    assert vehicle_cells(free, 3)[1:3, 1:3].all() and vehicle_cells(free, 3).sum() == 4
+    assert vehicle_cells(free, 2)[:3, :3].all() and not vehicle_cells(free, 2)[3].any()
+    assert vehicle_cells(free, 4)[1, 1] and vehicle_cells(free, 4).sum() == 1
+    assert not vehicle_cells(free, 5).any()
+
+def test_two_wide_corridor():
+    layout = corridor_layout(2)
+    for aisle_width in (1, 2):
+        routes = operation_routes(layout, aisle_width)
+        assert routes is not None
+        assert all(4 <= y <= 5 for _, y in routes[0])
+        assert csgraph_routes.operation_routes(layout, aisle_width) == routes
+        assert astar((1, 4), (12, 4), layout, aisle_width) is not None
+    assert operation_routes(layout, 3) is None
+    assert csgraph_routes.operation_routes(layout, 3) is None
+
+def test_one_wide_corridor():
+    layout = corridor_layout(1)
+    assert operation_routes(layout, 1) is not None
+    assert operation_routes(layout, 2) is None
+    assert astar((1, 4), (12, 4), layout, 2) is None
+
+def test_array_grids_of_equal_bytes():
+    # Same cells flattened, different shapes: the cached route of one must not answer the other
+    assert astar((0, 0), (1, 1), [[1, 1, 1], [1, 0, 1]]) is None
+    assert astar((0, 0), (1, 1), [[1, 1], [1, 1], [0, 1]]) == [(0, 0), (1, 1)]